@@ -1,7 +1,15 @@
+import os
+
 from flask import Flask
 from flask_cors import CORS
-from database.db import Base, engine
+from database.db import Base, engine, SessionLocal
 from routes import survey_routes
+from model.registry import warm_up_models, SHARED_DQN_CHECKPOINT
+from model.dqn.multi_start import start_allocation_pool
+from model.milp.milp_allocator import start_solver_server
+from model.dqn.train_predict import INFERENCE_THREADS
+import torch
+from model.rgcn.link_table import link_tables
 
 app = Flask(__name__)
 
@@ -11,11 +19,39 @@ CORS(app, supports_credentials=True, resources={r"/api/*": {"origins": "*"}})
 
 
 
-# Create tables
-Base.metadata.create_all(bind=engine)
-
 # Register routes
 app.register_blueprint(survey_routes)
 
+def start_services():
+    """
+    Startup work of the process that serves requests: tables, thread
+    settings, warm models, the allocation pool and the link-table worker.
+    """
+    # Create tables
+    Base.metadata.create_all(bind=engine)
+
+    # Allocation requests run single-threaded torch, set once for the process
+    torch.set_num_threads(INFERENCE_THREADS)
+
+    # Load model checkpoints once
+    warm_up_models()
+
+    # Start the allocation workers with the shared policy preloaded
+    start_allocation_pool([SHARED_DQN_CHECKPOINT])
+
+    # Start the MILP solver's forkserver outside any request's time limit
+    start_solver_server()
+
+    # Refresh predicted-link tables in the background
+    link_tables.start_worker(SessionLocal)
+
+
+# Nothing starts on import: the allocation pool's spawned workers import
+# this module too
 if __name__ == '__main__':
-    app.run(port=5002,debug=True)
\ No newline at end of file
+    debug = True
+    # the debug reloader runs this block in a file watcher and again in the
+    # child that serves requests (WERKZEUG_RUN_MAIN set); only the child starts services
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_services()
+    app.run(port=5002,debug=debug)
@@ -2,84 +2,149 @@ import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 
+# edge labels 0–4 are positive links, 5 is disrespect
+NUM_LINK_TYPES   = 6
+LINK_REWARDS     = np.array([100, 100, 100, 100, 100, -700], dtype=np.float32)
+NO_LINK_PENALTY  = -5
+OVERFILL_PENALTY = 20000.0
+
 class StudentAllocationEnv:
     def __init__(self, num_classes, target_class_size, target_feature_avgs, E):
         """
         Environment for student allocation with per-class targets.
 
+        State is array-backed: `counts` is (num_classes,), `sum_features` is
+        (num_classes, feature_dim) float32 and `members` holds the student
+        indices of each class. The observation is written into a preallocated
+        buffer whose target sections are filled once per episode.
+        `link_counts[s, c, r]` counts the members m of class c with
+        E[s, m] == r, so link rewards are a lookup instead of a member loop.
+
         Args:
           num_classes: number of classes
           target_class_size: desired size per class (scalar)
           target_feature_avgs: np.array of shape (num_classes, feature_dim)
-          E: link matrix (N x N) with integer edge labels
+          E: link store from precompute_link_matrices (dense N x N matrix of
+             integer edge labels or a SparseLinkMatrix)
         """
         self.num_classes          = num_classes
         self.target_class_size    = target_class_size
         self.target_feature_avgs  = target_feature_avgs
         self.feature_dim          = target_feature_avgs.shape[1]
         self.E                    = E
-        self.state                = self._init_state()
+        self.num_students         = E.shape[0]
+        # one row per class: [count, target_size, avg_1..avg_D, target_1..target_D]
+        self._obs = np.zeros((num_classes, 2 + 2 * self.feature_dim), dtype=np.float32)
+        self.reset()
 
     def reset(self):
         """Clears assignment state and returns initial observation vector."""
-        self.state = self._init_state()
+        self._init_state()
         return self.get_state()
 
-    def get_state(self):
-        """Returns the flattened state vector including counts, avgs, and targets."""
-        return state_to_vector(
-            self.state,
-            self.feature_dim,
-            self.target_class_size,
-            self.target_feature_avgs
-        )
+    def get_state(self, copy=True):
+        """
+        Returns the flattened state vector including counts, avgs, and targets.
+        With copy=False the live observation buffer is returned; it is
+        overwritten by the next step.
+        """
+        D = self.feature_dim
+        self._obs[:, 0] = self.counts
+        np.divide(self.sum_features,
+                  np.maximum(self.counts, 1)[:, None],
+                  out=self._obs[:, 2:2 + D])
+        obs = self._obs.reshape(-1)
+        return obs.copy() if copy else obs
+
+    def action_mask(self):
+        """
+        Boolean (num_classes,) mask of the classes that still have room.
+        Once every class is at its target size all classes are allowed.
+        """
+        mask = self.counts < self.target_class_size
+        return mask if mask.any() else np.ones(self.num_classes, dtype=bool)
 
     def _init_state(self):
-        return [
-            {'count': 0,
-             'sum_features': None,
-             'student_indices': []}
-            for _ in range(self.num_classes)
-        ]
+        D = self.feature_dim
+        self.counts       = np.zeros(self.num_classes, dtype=np.int64)
+        self.sum_features = np.zeros((self.num_classes, D), dtype=np.float32)
+        self.members      = [[] for _ in range(self.num_classes)]
+        self.assignment   = np.full(self.num_students, -1, dtype=np.int64)
+        self.link_counts  = np.zeros((self.num_students, self.num_classes, NUM_LINK_TYPES),
+                                     dtype=np.int32)
+        # static sections of the observation, written once per episode
+        self._obs[:, 0]       = 0.0
+        self._obs[:, 1]       = self.target_class_size
+        self._obs[:, 2:2 + D] = 0.0
+        self._obs[:, 2 + D:]  = self.target_feature_avgs
 
     def _update_state(self, class_idx, student_features, student_index):
-        if self.state[class_idx]['count'] == 0:
-            self.state[class_idx]['sum_features'] = np.array(student_features, dtype=np.float32)
-        else:
-            self.state[class_idx]['sum_features'] += np.array(student_features, dtype=np.float32)
-        self.state[class_idx]['count'] += 1
-        self.state[class_idx]['student_indices'].append(student_index)
+        self.counts[class_idx] += 1
+        self.sum_features[class_idx] += student_features
+        self.members[class_idx].append(student_index)
+        self.assignment[student_index] = class_idx
+        # every student s with a link s -> student_index now has one more
+        # member of that relation in class_idx
+        src, lbl = in_links(self.E, student_index)
+        self.link_counts[src, class_idx, lbl] += 1
+
+    def remove_student(self, student_index, student_features):
+        """Takes an allocated student back out of its class (inverse of _update_state)."""
+        class_idx = int(self.assignment[student_index])
+        if class_idx < 0:
+            return
+        self.counts[class_idx] -= 1
+        self.sum_features[class_idx] -= student_features
+        self.members[class_idx].remove(student_index)
+        self.assignment[student_index] = -1
+        src, lbl = in_links(self.E, student_index)
+        self.link_counts[src, class_idx, lbl] -= 1
+
+    def refresh_out_links(self, student_index):
+        """Recounts link_counts[student_index] after its outgoing links changed in E."""
+        dst, lbl = out_links(self.E, student_index)
+        cls = self.assignment[dst]
+        keep = cls >= 0
+        self.link_counts[student_index] = 0
+        np.add.at(self.link_counts[student_index], (cls[keep], lbl[keep]), 1)
+
+    def load_assignment(self, assignment, student_data, order=None):
+        """
+        Resets the env and replays a full (N,) class-label array into it,
+        skipping students labelled -1. `order` sets the replay order.
+        """
+        self._init_state()
+        if order is None:
+            order = np.arange(len(assignment))
+        for idx in order:
+            cls = int(assignment[idx])
+            if cls >= 0:
+                self._update_state(cls, student_data[idx], int(idx))
 
     def _get_class_avg(self, class_idx):
-        c = self.state[class_idx]
-        if c['count'] == 0:
+        if self.counts[class_idx] == 0:
             return np.zeros(self.feature_dim, dtype=np.float32)
-        return c['sum_features'] / c['count']
-
-    def compute_link_reward(self, new_idx, cls, E):
-        # unchanged from before
-        positive_reward = 100
-        negative_penalty = -700
-        no_link_penalty = -5
-
-        members = self.state[cls]['student_indices']
-        if not members:
-            return 0.0
-
-        total = 0.0
-        for other in members:
-            lbl = int(E[new_idx, other])
-            if lbl in [0,1,2,3,4]:
-                total += positive_reward
-            elif lbl == 5:
-                total += negative_penalty
-            else:
-                total += no_link_penalty
-        return total
+        return self.sum_features[class_idx] / self.counts[class_idx]
+
+    def compute_link_reward(self, new_idx, cls):
+        """Link reward of placing `new_idx` into class `cls`."""
+        per_rel = self.link_counts[new_idx, cls]
+        return float(per_rel @ LINK_REWARDS +
+                     NO_LINK_PENALTY * (self.counts[cls] - per_rel.sum()))
+
+    def compute_link_rewards(self, new_idx):
+        """
+        Link reward of placing `new_idx` into each class, shape (num_classes,).
+        Each existing member contributes LINK_REWARDS[label] if new_idx links
+        to it and NO_LINK_PENALTY otherwise.
+        """
+        per_rel = self.link_counts[new_idx]                  # (C, R)
+        linked  = per_rel.sum(axis=1)
+        return per_rel @ LINK_REWARDS + NO_LINK_PENALTY * (self.counts - linked)
 
     def compute_reward(self, student_features, action, student_index):
         # 1) size component
-        curr_count = self.state[action]['count']
+        curr_count = int(self.counts[action])
         new_count  = curr_count + 1
         size_diff  = abs(new_count - self.target_class_size) / self.target_class_size
         reward_size = -size_diff
@@ -88,7 +153,7 @@ class StudentAllocationEnv:
         if curr_count == 0:
             new_avg = np.array(student_features, dtype=np.float32)
         else:
-            new_avg = (self.state[action]['sum_features'] +
+            new_avg = (self.sum_features[action] +
                        np.array(student_features, dtype=np.float32)) / new_count
 
         eps = 1e-6
@@ -97,7 +162,7 @@ class StudentAllocationEnv:
         reward_features = -feature_diff
 
         # 3) link reward
-        reward_link = self.compute_link_reward(student_index, action, self.E)
+        reward_link = self.compute_link_reward(student_index, action)
         lambda_link = 1.0
 
         return reward_size + 2 * reward_features + lambda_link * reward_link
@@ -112,47 +177,366 @@ class StudentAllocationEnv:
         # always record assignment
         self._update_state(action, student_features, student_index)
         # over-fill penalty
-        if self.state[action]['count'] > self.target_class_size:
-            r -= 20000.0
+        if self.counts[action] > self.target_class_size:
+            r -= OVERFILL_PENALTY
         return r, False
 
 
-def state_to_vector(state,
-                    feature_dim,
-                    target_class_size,
-                    target_feature_avgs):
+class VecAllocationEnv:
+    def __init__(self, num_envs, num_classes, target_class_size,
+                 target_feature_avgs, E, student_data):
+        """
+        K independent allocation episodes over the same unit, stepped in
+        lockstep. Episode k visits the students in its own shuffled order,
+        so every step places one student per episode and returns a
+        (K, state_dim) observation batch for a single forward pass.
+
+        Args:
+          num_envs: number of parallel episodes K
+          num_classes, target_class_size, target_feature_avgs, E:
+            as for StudentAllocationEnv
+          student_data: (N x feature_dim) feature matrix
+        """
+        self.num_envs             = num_envs
+        self.num_classes          = num_classes
+        self.target_class_size    = target_class_size
+        self.target_feature_avgs  = target_feature_avgs
+        self.feature_dim          = target_feature_avgs.shape[1]
+        self.E                    = E
+        self.student_data         = np.asarray(student_data, dtype=np.float32)
+        self.num_students         = self.student_data.shape[0]
+        self._targets             = np.asarray(target_feature_avgs, dtype=np.float32)
+        self._target_norms        = np.linalg.norm(self._targets, axis=1) + 1e-6
+        self._obs = np.zeros((num_envs, num_classes, 2 + 2 * self.feature_dim),
+                             dtype=np.float32)
+        self.reset()
+
+    def reset(self, orders=None):
+        """
+        Starts K new episodes and returns the (K, state_dim) observation.
+        `orders` is an optional (K, N) array of student visiting orders;
+        by default each episode gets its own random permutation.
+        """
+        K, C, D, N = self.num_envs, self.num_classes, self.feature_dim, self.num_students
+        if orders is None:
+            orders = np.stack([np.random.permutation(N) for _ in range(K)])
+        self.orders       = np.asarray(orders, dtype=np.int64)
+        self.t            = 0
+        self.counts       = np.zeros((K, C), dtype=np.int64)
+        self.sum_features = np.zeros((K, C, D), dtype=np.float32)
+        self.assignment   = np.full((K, N), -1, dtype=np.int64)
+        self._obs[:, :, 0]       = 0.0
+        self._obs[:, :, 1]       = self.target_class_size
+        self._obs[:, :, 2:2 + D] = 0.0
+        self._obs[:, :, 2 + D:]  = self._targets
+        return self.get_state()
+
+    def select(self, parents):
+        """
+        Replaces episode k with a copy of episode parents[k]. Used by beam
+        search to keep the surviving partial allocations; the episode state
+        is O(N + C * D) per beam, as links are read from E and the
+        assignment rather than kept per episode.
+        """
+        parents = np.asarray(parents, dtype=np.int64)
+        if (parents == np.arange(self.num_envs)).all():
+            return
+        self.orders       = self.orders[parents]
+        self.counts       = self.counts[parents]
+        self.sum_features = self.sum_features[parents]
+        self.assignment   = self.assignment[parents]
+
+    def action_masks(self):
+        """(num_envs, num_classes) version of StudentAllocationEnv.action_mask."""
+        mask = self.counts < self.target_class_size
+        mask[~mask.any(axis=1)] = True
+        return mask
+
+    def current_students(self):
+        """Student index each episode places at the current step, shape (K,)."""
+        return self.orders[:, self.t]
+
+    def get_state(self, copy=True):
+        """Returns the (K, state_dim) batch of flattened state vectors."""
+        D = self.feature_dim
+        self._obs[:, :, 0] = self.counts
+        np.divide(self.sum_features,
+                  np.maximum(self.counts, 1)[:, :, None],
+                  out=self._obs[:, :, 2:2 + D])
+        obs = self._obs.reshape(self.num_envs, -1)
+        return obs.copy() if copy else obs
+
+    def step(self, actions):
+        """
+        Places the current student of every episode into its chosen class.
+        Rewards follow StudentAllocationEnv.step, including the over-fill
+        penalty. Returns (rewards of shape (K,), done).
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        k       = np.arange(self.num_envs)
+        idx     = self.current_students()
+        feats   = self.student_data[idx]
+
+        # 1) size component
+        curr_count  = self.counts[k, actions]
+        new_count   = curr_count + 1
+        reward_size = -np.abs(new_count - self.target_class_size) / self.target_class_size
+
+        # 2) feature balance
+        new_avg = (self.sum_features[k, actions] + feats) / new_count[:, None]
+        tgt     = self._targets[actions]
+        reward_features = -np.linalg.norm(new_avg - tgt, axis=1) / self._target_norms[actions]
+
+        # 3) link reward: out-links of each student into its chosen class
+        grp, dst, lbl = out_links_batch(self.E, idx)
+        hit     = self.assignment[grp, dst] == actions[grp]
+        per_rel = np.zeros((self.num_envs, NUM_LINK_TYPES), dtype=np.int64)
+        np.add.at(per_rel, (grp[hit], lbl[hit]), 1)
+        reward_link = (per_rel @ LINK_REWARDS +
+                       NO_LINK_PENALTY * (curr_count - per_rel.sum(axis=1)))
+
+        rewards = reward_size + 2 * reward_features + reward_link
+
+        # update state
+        self.counts[k, actions]       += 1
+        self.sum_features[k, actions] += feats
+        self.assignment[k, idx]        = actions
+
+        # over-fill penalty
+        rewards[self.counts[k, actions] > self.target_class_size] -= OVERFILL_PENALTY
+
+        self.t += 1
+        return rewards, self.t == self.num_students
+
+
+# units above this size get a SparseLinkMatrix from precompute_link_matrices
+DENSE_LINK_LIMIT = 2000
+
+
+class SparseLinkMatrix:
     """
-    Flattens state into a vector of length num_classes*(2 + 2*feature_dim):
-      For each class idx:
-        [ raw_count,
-          target_class_size,
-          avg_feat_1…avg_feat_D,
-          target_feat_1…target_feat_D ]
+    Sparse (N x N) store of integer edge labels.
+
+    Out-links are kept in CSR order and in-links in CSC order, so both
+    directions are O(degree) lookups. Missing pairs read as -1, which
+    matches the dense matrix, so `int(E[u, v])` works on either store.
     """
-    vec = []
-    for cls_idx, c in enumerate(state):
-        cnt = c['count']
-        # raw count
-        vec.append(float(cnt))
-        # target size
-        vec.append(float(target_class_size))
-        # average features
-        if cnt > 0:
-            avg = c['sum_features'] / cnt
-        else:
-            avg = np.zeros(feature_dim, dtype=np.float32)
-        vec.extend(avg.tolist())
-        # target features for this class
-        vec.extend(target_feature_avgs[cls_idx].tolist())
-    return np.array(vec, dtype=np.float32)
+    def __init__(self, src, dst, labels, num_nodes):
+        self.shape = (num_nodes, num_nodes)
+        self.nnz   = len(src)
+
+        order = np.lexsort((dst, src))
+        self.indptr  = _indptr(src, num_nodes)
+        self.indices = dst[order]
+        self.labels  = labels[order]
+
+        order_t = np.lexsort((src, dst))
+        self.indptr_t  = _indptr(dst, num_nodes)
+        self.indices_t = src[order_t]
+        self.labels_t  = labels[order_t]
+
+    def __getitem__(self, key):
+        u, v = key
+        lo, hi = self.indptr[u], self.indptr[u + 1]
+        pos = lo + np.searchsorted(self.indices[lo:hi], v)
+        if pos < hi and self.indices[pos] == v:
+            return self.labels[pos]
+        return -1
+
+    def __repr__(self):
+        return f"SparseLinkMatrix(shape={self.shape}, nnz={self.nnz})"
+
+    def out_links(self, u):
+        """Returns (targets, labels) of the links leaving u."""
+        lo, hi = self.indptr[u], self.indptr[u + 1]
+        return self.indices[lo:hi], self.labels[lo:hi]
+
+    def in_links(self, v):
+        """Returns (sources, labels) of the links pointing at v."""
+        lo, hi = self.indptr_t[v], self.indptr_t[v + 1]
+        return self.indices_t[lo:hi], self.labels_t[lo:hi]
+
+    def to_coo(self):
+        """Returns (src, dst, labels) arrays of every stored link."""
+        src = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        return src, self.indices, self.labels
+
+    def toarray(self, dtype=np.int8):
+        E = np.full(self.shape, -1, dtype=dtype)
+        src, dst, lbl = self.to_coo()
+        E[src, dst] = lbl
+        return E
 
 
-def precompute_link_matrices(graph_data):
-    """Builds an (N x N) matrix of edge labels from a PyG Data object."""
+def _indptr(rows, num_nodes):
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+    return indptr
+
+
+def in_links(E, v):
+    """Returns (sources, labels) of all valid links pointing at v."""
+    if isinstance(E, SparseLinkMatrix):
+        src, lbl = E.in_links(v)
+    else:
+        col = E[:, v]
+        src = np.flatnonzero(col >= 0)
+        lbl = col[src]
+    keep = lbl < NUM_LINK_TYPES
+    return src[keep], lbl[keep]
+
+
+def out_links(E, u):
+    """Returns (targets, labels) of all valid links leaving u."""
+    if isinstance(E, SparseLinkMatrix):
+        dst, lbl = E.out_links(u)
+    else:
+        row = E[u]
+        dst = np.flatnonzero(row >= 0)
+        lbl = row[dst]
+    keep = lbl < NUM_LINK_TYPES
+    return dst[keep], lbl[keep]
+
+
+def in_links_batch(E, nodes):
+    """
+    In-links of several nodes at once. Returns (group, sources, labels)
+    where group[i] is the position in `nodes` that link i points at.
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    if isinstance(E, SparseLinkMatrix):
+        starts = E.indptr_t[nodes]
+        lens   = E.indptr_t[nodes + 1] - starts
+        grp    = np.repeat(np.arange(len(nodes)), lens)
+        offs   = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+        pos    = np.repeat(starts, lens) + offs
+        src, lbl = E.indices_t[pos], E.labels_t[pos]
+    else:
+        cols = E[:, nodes]
+        src, grp = np.nonzero(cols >= 0)
+        lbl = cols[src, grp]
+    keep = lbl < NUM_LINK_TYPES
+    return grp[keep], src[keep], lbl[keep]
+
+
+def out_links_batch(E, nodes):
+    """
+    Out-links of several nodes at once. Returns (group, targets, labels)
+    where group[i] is the position in `nodes` that link i leaves from.
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    if isinstance(E, SparseLinkMatrix):
+        starts = E.indptr[nodes]
+        lens   = E.indptr[nodes + 1] - starts
+        grp    = np.repeat(np.arange(len(nodes)), lens)
+        offs   = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+        pos    = np.repeat(starts, lens) + offs
+        dst, lbl = E.indices[pos], E.labels[pos]
+    else:
+        rows = E[nodes]
+        grp, dst = np.nonzero(rows >= 0)
+        lbl = rows[grp, dst]
+    keep = lbl < NUM_LINK_TYPES
+    return grp[keep], dst[keep], lbl[keep]
+
+
+def link_edges(E):
+    """Returns (src, dst, labels) of all valid links in either link store."""
+    if isinstance(E, SparseLinkMatrix):
+        src, dst, lbl = E.to_coo()
+    else:
+        src, dst = np.nonzero(E >= 0)
+        lbl = E[src, dst]
+    keep = lbl < NUM_LINK_TYPES
+    return src[keep], dst[keep], lbl[keep]
+
+
+def link_counts_by_class(E, assignment, num_classes):
+    """
+    Counts, per class and relation, the links whose two ends sit in the
+    same class, using one bincount over the link store.
+
+    Args:
+      E: dense link matrix or SparseLinkMatrix
+      assignment: (N,) class label per student, -1 for unassigned
+      num_classes: number of classes
+
+    Returns:
+      (num_classes x NUM_LINK_TYPES) int array
+    """
+    src, dst, lbl = link_edges(E)
+    cls  = assignment[src]
+    same = (cls >= 0) & (cls == assignment[dst]) & (src != dst)
+    flat = cls[same] * NUM_LINK_TYPES + lbl[same]
+    counts = np.bincount(flat, minlength=num_classes * NUM_LINK_TYPES)
+    return counts.reshape(num_classes, NUM_LINK_TYPES)
+
+
+def sub_link_matrix(E, nodes, sparse=None):
+    """
+    Link store restricted to `nodes`, re-indexed so nodes[i] becomes i.
+    The result is dense unless it has more than DENSE_LINK_LIMIT nodes
+    (or sparse=True).
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    n = len(nodes)
+    pos = np.full(E.shape[0], -1, dtype=np.int64)
+    pos[nodes] = np.arange(n)
+    src, dst, lbl = link_edges(E)
+    keep = (pos[src] >= 0) & (pos[dst] >= 0)
+    src, dst, lbl = pos[src[keep]], pos[dst[keep]], lbl[keep]
+    if sparse is None:
+        sparse = n > DENSE_LINK_LIMIT
+    if sparse:
+        return SparseLinkMatrix(src, dst, lbl, n)
+    sub = np.full((n, n), -1, dtype=np.int8)
+    sub[src, dst] = lbl
+    return sub
+
+
+def replace_out_links(E, sources, src, dst, labels):
+    """
+    Replaces every outgoing link of `sources` with the (src, dst, labels)
+    links given for them. A dense matrix is updated in place; a
+    SparseLinkMatrix is rebuilt, so callers must use the returned store.
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    if isinstance(E, SparseLinkMatrix):
+        old_src, old_dst, old_lbl = E.to_coo()
+        keep = ~np.isin(old_src, sources)
+        return SparseLinkMatrix(np.concatenate([old_src[keep], src]),
+                                np.concatenate([old_dst[keep], dst]),
+                                np.concatenate([old_lbl[keep], labels]).astype(np.int8),
+                                E.shape[0])
+    E[sources] = -1
+    E[src, dst] = labels
+    return E
+
+
+def precompute_link_matrices(graph_data, sparse=None):
+    """
+    Builds the link store of edge labels from a PyG Data object.
+
+    Small units get a dense (N x N) int8 matrix filled with -1; units with
+    more than DENSE_LINK_LIMIT students (or sparse=True) get a
+    SparseLinkMatrix. Repeated (u, v) pairs keep the last label, as before.
+    """
     num_nodes = graph_data.x.shape[0]
-    E = np.full((num_nodes, num_nodes), -1, dtype=int)
-    for i in range(graph_data.edge_index.shape[1]):
-        u = int(graph_data.edge_index[0, i])
-        v = int(graph_data.edge_index[1, i])
-        E[u, v] = int(graph_data.edge_attr[i])
-    return E
\ No newline at end of file
+    if sparse is None:
+        sparse = num_nodes > DENSE_LINK_LIMIT
+
+    src = graph_data.edge_index[0].cpu().numpy().astype(np.int64)
+    dst = graph_data.edge_index[1].cpu().numpy().astype(np.int64)
+    lbl = graph_data.edge_attr.cpu().numpy().astype(np.int8)
+
+    # keep the last label written for each (u, v) pair
+    key = src * num_nodes + dst
+    _, last = np.unique(key[::-1], return_index=True)
+    last = len(key) - 1 - last
+    src, dst, lbl = src[last], dst[last], lbl[last]
+
+    if sparse:
+        return SparseLinkMatrix(src, dst, lbl, num_nodes)
+    E = np.full((num_nodes, num_nodes), -1, dtype=np.int8)
+    E[src, dst] = lbl
+    return E
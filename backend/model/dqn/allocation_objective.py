@@ -0,0 +1,102 @@
+# allocation_objective.py
+import numpy as np
+
+from model.dqn.allocation_env import LINK_REWARDS, NO_LINK_PENALTY, OVERFILL_PENALTY, NUM_LINK_TYPES
+from model.dqn.allocation_env import link_edges
+
+
+class AllocationEvaluator:
+    def __init__(self, student_data, num_classes, target_class_size, target_feature_avgs, E):
+        """
+        Scores complete assignment vectors without replaying them through
+        StudentAllocationEnv. The link store is flattened to COO once, so
+        every evaluation is a handful of bincounts over students and links.
+
+        The objective matches LocalSearchState.objective (higher is better):
+          size     -Σ_c |n_c - T| / T  -  OVERFILL_PENALTY * Σ_c max(n_c - T, 0)
+          features -2 Σ_c ||avg_c - tgt_c|| / ||tgt_c||
+          links    each same-class pair scores the mean of its two directed
+                   link rewards (NO_LINK_PENALTY when unlinked)
+        """
+        self.X = np.asarray(student_data, dtype=np.float64)
+        self.num_classes = num_classes
+        self.T = target_class_size
+        self.targets = np.asarray(target_feature_avgs, dtype=np.float64)
+        self.target_norms = np.linalg.norm(self.targets, axis=1) + 1e-6
+
+        src, dst, lbl = link_edges(E)
+        keep = src != dst
+        self.src, self.dst, self.lbl = src[keep], dst[keep], lbl[keep].astype(np.int64)
+
+    def evaluate_batch(self, labels):
+        """
+        Evaluates M assignments at once.
+
+        Args:
+          labels: (M x N) class per student; -1 marks an unassigned student
+
+        Returns:
+          dict of arrays with a leading M axis:
+            counts          (M, C)  students per class
+            size_deviation  (M, C)  |n_c - T| / T
+            overfill        (M, C)  max(n_c - T, 0)
+            feature_avgs    (M, C, D)
+            feature_error   (M, C)  ||avg_c - tgt_c|| / ||tgt_c||
+            link_counts     (M, C, 6) same-class links per relation
+            no_link         (M, C)  ordered same-class pairs without a link
+            unassigned      (M,)
+            objective       (M,)
+        """
+        L = np.atleast_2d(np.asarray(labels, dtype=np.int64))
+        M, N = L.shape
+        C, D, R = self.num_classes, self.X.shape[1], NUM_LINK_TYPES
+        rows = np.arange(M)[:, None]
+
+        # unassigned students go to an extra bucket C that is dropped
+        cls = np.where(L >= 0, L, C)
+        group = (rows * (C + 1) + cls).ravel()
+        counts = np.bincount(group, minlength=M * (C + 1)).reshape(M, C + 1)[:, :C]
+        sums = np.stack([np.bincount(group, weights=np.tile(self.X[:, d], M), minlength=M * (C + 1))
+                         for d in range(D)], axis=-1).reshape(M, C + 1, D)[:, :C]
+        avgs = sums / np.maximum(counts, 1)[..., None]
+        feature_error = np.linalg.norm(avgs - self.targets, axis=-1) / self.target_norms
+
+        src_cls = cls[:, self.src]
+        same = (src_cls < C) & (src_cls == cls[:, self.dst])
+        flat = ((rows * C + src_cls) * R + self.lbl)[same]
+        link_counts = np.bincount(flat, minlength=M * C * R).reshape(M, C, R)
+        pairs = counts * (counts - 1)
+        no_link = pairs - link_counts.sum(axis=-1)
+
+        size_deviation = np.abs(counts - self.T) / self.T
+        overfill = np.maximum(counts - self.T, 0)
+        # directed same-class links earn half their gain over "no link"
+        link_term = (0.5 * (link_counts * (LINK_REWARDS - NO_LINK_PENALTY)).sum(axis=(1, 2)) +
+                     NO_LINK_PENALTY * 0.5 * pairs.sum(axis=1))
+        objective = (-(size_deviation + OVERFILL_PENALTY * overfill).sum(axis=1)
+                     - 2 * feature_error.sum(axis=1) + link_term)
+
+        return {
+            'counts':         counts,
+            'size_deviation': size_deviation,
+            'overfill':       overfill,
+            'feature_avgs':   avgs,
+            'feature_error':  feature_error,
+            'link_counts':    link_counts,
+            'no_link':        no_link,
+            'unassigned':     (L < 0).sum(axis=1),
+            'objective':      objective,
+        }
+
+    def evaluate(self, labels):
+        """Evaluates a single (N,) assignment; same keys as evaluate_batch without the M axis."""
+        return {k: v[0] for k, v in self.evaluate_batch(np.asarray(labels)[None]).items()}
+
+
+def evaluate_allocation(labels, student_data, num_classes, target_class_size, target_feature_avgs, E):
+    """One-off evaluation of an (N,) or (M x N) assignment; see AllocationEvaluator."""
+    evaluator = AllocationEvaluator(student_data, num_classes, target_class_size, target_feature_avgs, E)
+    labels = np.asarray(labels)
+    if labels.ndim == 2:
+        return evaluator.evaluate_batch(labels)
+    return evaluator.evaluate(labels)
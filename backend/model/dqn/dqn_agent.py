@@ -1,8 +1,75 @@
+import copy
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import random
-from collections import deque
+
+def masked_argmax(q_values, masks):
+    """Row-wise argmax of a (K, A) array over the actions allowed by `masks`."""
+    if masks is None:
+        return q_values.argmax(axis=1)
+    return np.where(masks, q_values, -np.inf).argmax(axis=1)
+
+
+class ReplayBuffer:
+    def __init__(self, capacity, state_dim, action_dim=1):
+        """
+        Fixed-size ring buffer of transitions backed by preallocated tensors.
+        Once full, new transitions overwrite the oldest ones.
+
+        Parameters:
+          capacity: Maximum number of stored transitions.
+          state_dim: Dimension of the state vector.
+          action_dim: Number of actions; the feasible-action mask of each
+                      next state is stored alongside (all True if not given).
+        """
+        self.capacity = capacity
+        self.states = torch.zeros((capacity, state_dim), dtype=torch.float32)
+        self.actions = torch.zeros((capacity, 1), dtype=torch.int64)
+        self.rewards = torch.zeros((capacity, 1), dtype=torch.float32)
+        self.next_states = torch.zeros((capacity, state_dim), dtype=torch.float32)
+        self.dones = torch.zeros((capacity, 1), dtype=torch.float32)
+        self.next_masks = torch.ones((capacity, action_dim), dtype=torch.bool)
+        self.pos = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, state, action, reward, next_state, done, next_mask=None):
+        """Writes a single transition at the current ring position."""
+        i = self.pos
+        self.states[i] = torch.from_numpy(np.asarray(state, dtype=np.float32))
+        self.actions[i, 0] = int(action)
+        self.rewards[i, 0] = float(reward)
+        self.next_states[i] = torch.from_numpy(np.asarray(next_state, dtype=np.float32))
+        self.dones[i, 0] = float(done)
+        self.next_masks[i] = True if next_mask is None else torch.from_numpy(np.asarray(next_mask, dtype=bool))
+        self.pos = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def push_batch(self, states, actions, rewards, next_states, dones, next_masks=None):
+        """Writes a batch of transitions (one per row), wrapping around the ring."""
+        n = len(states)
+        idx = torch.from_numpy((self.pos + np.arange(n)) % self.capacity)
+        self.states[idx] = torch.from_numpy(np.asarray(states, dtype=np.float32))
+        self.actions[idx, 0] = torch.from_numpy(np.asarray(actions, dtype=np.int64))
+        self.rewards[idx, 0] = torch.from_numpy(np.asarray(rewards, dtype=np.float32))
+        self.next_states[idx] = torch.from_numpy(np.asarray(next_states, dtype=np.float32))
+        self.dones[idx, 0] = torch.from_numpy(np.broadcast_to(np.asarray(dones, dtype=np.float32), (n,)).copy())
+        self.next_masks[idx] = True if next_masks is None else torch.from_numpy(np.asarray(next_masks, dtype=bool))
+        self.pos = int((self.pos + n) % self.capacity)
+        self.size = min(self.size + n, self.capacity)
+
+    def sample(self, batch_size):
+        """
+        Samples batch_size transitions uniformly with one index tensor.
+        Returns (states, actions, rewards, next_states, dones, next_masks) tensors.
+        """
+        idx = torch.randint(0, self.size, (batch_size,))
+        return (self.states[idx], self.actions[idx], self.rewards[idx],
+                self.next_states[idx], self.dones[idx], self.next_masks[idx])
 
 class DQN(nn.Module):
     def __init__(self, state_dim, action_dim):
@@ -23,8 +90,111 @@ class DQN(nn.Module):
         x = torch.relu(self.fc2(x))
         return self.fc3(x)
 
+class SharedClassDQN(nn.Module):
+    def __init__(self, feature_dim, hidden_dim=128):
+        """
+        Class-count-agnostic Q-network. The state is split into per-class
+        slots [count, target_size, avg, target]; one shared MLP scores every
+        slot together with the mean over all slots, so the same weights
+        serve any number of classes.
+
+        feature_dim: Number of student features D (slot size is 2 + 2D).
+        hidden_dim: Width of the shared per-class MLP.
+        """
+        super(SharedClassDQN, self).__init__()
+        self.feature_dim = feature_dim
+        self.slot_dim = 2 + 2 * feature_dim
+        # per-class input: fill ratio, avg, target, avg - target
+        class_dim = 1 + 3 * feature_dim
+        self.class_fc1 = nn.Linear(2 * class_dim, hidden_dim)
+        self.class_fc2 = nn.Linear(hidden_dim, hidden_dim // 2)
+        self.class_fc3 = nn.Linear(hidden_dim // 2, 1)
+
+    def forward(self, x):
+        """
+        Forward pass: (batch_size, C * slot_dim) -> (batch_size, C) Q-values,
+        with all B * C class slots scored as one batch.
+        """
+        slots = x.unflatten(-1, (-1, self.slot_dim))                 # (B, C, slot)
+        D = self.feature_dim
+        count, size = slots[..., :1], slots[..., 1:2]
+        avg, target = slots[..., 2:2 + D], slots[..., 2 + D:]
+        h = torch.cat([count / size.clamp(min=1.0), avg, target, avg - target], dim=-1)
+        context = h.mean(dim=1, keepdim=True).expand_as(h)
+        h = torch.relu(self.class_fc1(torch.cat([h, context], dim=-1)))
+        h = torch.relu(self.class_fc2(h))
+        return self.class_fc3(h).squeeze(-1)
+
+
+def example_state_dim(model):
+    """Width of a state vector the model accepts, e.g. for tracing."""
+    if isinstance(model, SharedClassDQN):
+        return 2 * model.slot_dim
+    return model.fc1.in_features
+
+
+class InferencePolicy:
+    def __init__(self, model, state_dim, mode="trace", num_threads=None, compiled=None):
+        """
+        Greedy policy over a frozen copy of a DQN, for request-time inference.
+
+        Parameters:
+          model: Trained DQN module.
+          state_dim: Dimension of the state vector.
+          mode: "trace" for a TorchScript-traced copy, "int8" for a dynamically
+                int8-quantized and traced copy, "eager" for a plain eval copy.
+          num_threads: If set, pins torch intra-op threads for this process.
+          compiled: Module already built by compile_for_inference (e.g. a
+                    cached one); it is shared, only the input buffer is not.
+        """
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.mode = mode
+        # the input tensor is reused for every call; _input_np shares its memory
+        self._input = torch.zeros((1, state_dim), dtype=torch.float32)
+        self._input_np = self._input.numpy()
+        if compiled is None:
+            compiled = compile_for_inference(model, state_dim, mode)
+        self.model = compiled
+
+    def act(self, state, mask=None):
+        """Returns the greedy action for a single state vector, among `mask` if given."""
+        self._input_np[0] = state
+        with torch.inference_mode():
+            q_values = self.model(self._input)
+        if mask is None:
+            return int(q_values.argmax())
+        return int(masked_argmax(q_values.numpy(), mask[None])[0])
+
+    def q_values(self, states):
+        """Q-values for a (K, state_dim) batch, as a (K, action_dim) array."""
+        states_tensor = torch.from_numpy(np.ascontiguousarray(states, dtype=np.float32))
+        with torch.inference_mode():
+            return self.model(states_tensor).numpy()
+
+    def act_batch(self, states, masks=None):
+        """Greedy actions for a (K, state_dim) batch with one forward pass."""
+        return masked_argmax(self.q_values(states), masks)
+
+
+def compile_for_inference(model, state_dim, mode="trace"):
+    """Returns an eval-mode copy of `model` prepared for the given inference mode."""
+    model = copy.deepcopy(model).eval()
+    if mode == "eager":
+        return model
+    if mode == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    elif mode != "trace":
+        raise ValueError(f"Unknown inference mode: {mode}")
+    with torch.no_grad():
+        # SharedClassDQN only reshapes its input, so the trace holds for any class count
+        return torch.jit.trace(model, torch.zeros((1, state_dim), dtype=torch.float32))
+
+
 class DQNAgent:
-    def __init__(self, state_dim, action_dim, lr=0.001, gamma=0.9, epsilon=0.5, epsilon_decay=0.999, min_epsilon=0.01):
+    def __init__(self, state_dim, action_dim, lr=0.001, gamma=0.9, epsilon=0.5, epsilon_decay=0.999, min_epsilon=0.01,
+                 memory_size=10000, train_every=4, gradient_steps=1, target_update_every=100, double_dqn=False,
+                 model=None):
         """
         Initializes the DQN agent.
         
@@ -36,6 +206,17 @@ class DQNAgent:
           epsilon: Initial exploration rate.
           epsilon_decay: Factor by which epsilon decays.
           min_epsilon: Minimum exploration rate.
+          memory_size: Capacity of the replay buffer; 0 builds an
+                       inference-only agent without optimizer, replay
+                       buffer or target network.
+          train_every: Transitions between updates in train_step.
+          gradient_steps: Gradient steps run per update.
+          target_update_every: Gradient steps between target network syncs;
+                               0 bootstraps from the online network.
+          double_dqn: Pick next actions with the online network and value
+                      them with the target network.
+          model: Optional already-built DQN (or SharedClassDQN) to use as
+                 the online network; the target network copies its type.
         """
         self.state_dim = state_dim
         self.action_dim = action_dim
@@ -44,49 +225,132 @@ class DQNAgent:
         self.epsilon_decay = epsilon_decay
         self.min_epsilon = min_epsilon
         self.lr = lr
-        self.model = DQN(state_dim, action_dim)
-        self.optimizer = optim.Adam(self.model.parameters(), lr=self.lr)
+        self.model = model if model is not None else DQN(state_dim, action_dim)
         self.criterion = nn.MSELoss()
-        self.memory = deque(maxlen=10000)
+        self.train_every = train_every
+        self.gradient_steps = gradient_steps
+        self.target_update_every = target_update_every
+        self.double_dqn = double_dqn
+        if memory_size:
+            self.optimizer = optim.Adam(self.model.parameters(), lr=self.lr)
+            self.memory = ReplayBuffer(memory_size, state_dim, action_dim)
+            self.target_model = copy.deepcopy(self.model)
+            self.target_model.eval()
+        else:
+            self.optimizer = self.memory = self.target_model = None
+        self.env_steps = 0
+        self.grad_steps = 0
+        self.policy = None
     
-    def remember(self, state, action, reward, next_state, done):
-        """Stores a transition (state, action, reward, next_state, done) in replay memory."""
-        self.memory.append((state, action, reward, next_state, done))
+    def remember(self, state, action, reward, next_state, done, next_mask=None):
+        """
+        Stores a transition (state, action, reward, next_state, done) in replay
+        memory, with the feasible-action mask of next_state if given.
+        """
+        self.memory.push(state, action, reward, next_state, done, next_mask)
     
-    def act(self, state):
+    def enable_inference(self, mode="trace", num_threads=None, compiled=None):
         """
-        Selects an action using an epsilon-greedy policy.
+        Switches act/act_batch to a compiled greedy InferencePolicy and turns
+        exploration off. Call again after changing the weights.
+        """
+        self.model.eval()
+        self.epsilon = 0.0
+        self.policy = InferencePolicy(self.model, self.state_dim, mode, num_threads, compiled)
+
+    def act(self, state, mask=None):
+        """
+        Selects an action using an epsilon-greedy policy, restricted to the
+        actions allowed by `mask` (e.g. env.action_mask()) when given.
         Returns an integer in [0, action_dim-1].
         """
         if random.random() < self.epsilon:
-            return random.randrange(self.action_dim)
+            if mask is None:
+                return random.randrange(self.action_dim)
+            return int(random.choice(np.flatnonzero(mask)))
+        if self.policy is not None:
+            return self.policy.act(state, mask)
         state_tensor = torch.FloatTensor(state).unsqueeze(0)  # add batch dimension
         with torch.no_grad():
-            q_values = self.model(state_tensor)
-        return int(torch.argmax(q_values).item())
+            q_values = self.model(state_tensor).numpy()
+        return int(masked_argmax(q_values, None if mask is None else mask[None])[0])
     
+    def act_batch(self, states, masks=None):
+        """
+        Epsilon-greedy actions for a (K, state_dim) batch of states,
+        using a single forward pass, restricted to the (K, action_dim)
+        `masks` when given. Returns an int array of shape (K,).
+        """
+        if self.policy is not None and self.epsilon == 0.0:
+            return self.policy.act_batch(states, masks)
+        states_tensor = torch.from_numpy(np.ascontiguousarray(states, dtype=np.float32))
+        with torch.no_grad():
+            actions = masked_argmax(self.model(states_tensor).numpy(), masks)
+        explore = np.random.random(len(actions)) < self.epsilon
+        if masks is None:
+            actions[explore] = np.random.randint(self.action_dim, size=int(explore.sum()))
+        else:
+            # uniform over the allowed actions via random scores
+            noise = np.where(masks[explore], np.random.random(masks[explore].shape), -1.0)
+            actions[explore] = noise.argmax(axis=1)
+        return actions
+
+    def q_values(self, states):
+        """Q-values for a (K, state_dim) batch as a (K, action_dim) array."""
+        if self.policy is not None:
+            return self.policy.q_values(states)
+        states_tensor = torch.from_numpy(np.ascontiguousarray(states, dtype=np.float32))
+        with torch.no_grad():
+            return self.model(states_tensor).numpy()
+
+    def remember_batch(self, states, actions, rewards, next_states, done, next_masks=None):
+        """Stores one transition per row of a batched environment step."""
+        self.memory.push_batch(states, actions, rewards, next_states, done, next_masks)
+
+    def sync_target(self):
+        """Copies the online network weights into the target network."""
+        self.target_model.load_state_dict(self.model.state_dict())
+
+    def train_step(self, batch_size, n_transitions=1):
+        """
+        Call once per environment step with the number of transitions it
+        stored (num_envs for a batched step). Runs gradient_steps replays
+        per train_every transitions and decays epsilon once per transition,
+        so the schedules do not depend on how many envs run in parallel.
+        """
+        updates = (self.env_steps + n_transitions) // self.train_every - self.env_steps // self.train_every
+        self.env_steps += n_transitions
+        for _ in range(updates * self.gradient_steps):
+            self.replay(batch_size)
+        if self.epsilon > self.min_epsilon:
+            self.epsilon = max(self.min_epsilon, self.epsilon * self.epsilon_decay ** n_transitions)
+
     def replay(self, batch_size):
         """
-        Samples a random mini-batch from replay memory and trains the network.
+        Samples a random mini-batch from replay memory and runs one gradient
+        step, bootstrapping from the target network. The max over next
+        actions only considers the actions feasible in the next state.
         """
         if len(self.memory) < batch_size:
             return
-        batch = random.sample(self.memory, batch_size)
-        states, actions, rewards, next_states, dones = zip(*batch)
-        states = torch.FloatTensor(states)
-        actions = torch.LongTensor(actions).unsqueeze(1)
-        rewards = torch.FloatTensor(rewards).unsqueeze(1)
-        next_states = torch.FloatTensor(next_states)
-        dones = torch.FloatTensor(dones).unsqueeze(1)
+        states, actions, rewards, next_states, dones, next_masks = self.memory.sample(batch_size)
         
         current_q = self.model(states).gather(1, actions)
-        next_q = self.model(next_states).max(1)[0].unsqueeze(1)
+        bootstrap = self.target_model if self.target_update_every else self.model
+        with torch.no_grad():
+            if self.double_dqn:
+                online_q = self.model(next_states).masked_fill(~next_masks, float('-inf'))
+                next_actions = online_q.argmax(1, keepdim=True)
+                next_q = bootstrap(next_states).gather(1, next_actions)
+            else:
+                next_q = bootstrap(next_states).masked_fill(~next_masks, float('-inf')).max(1)[0].unsqueeze(1)
         target_q = rewards + self.gamma * next_q * (1 - dones)
         
-        loss = self.criterion(current_q, target_q.detach())
+        loss = self.criterion(current_q, target_q)
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
-        
-        if self.epsilon > self.min_epsilon:
-            self.epsilon *= self.epsilon_decay
\ No newline at end of file
+
+        self.grad_steps += 1
+        if self.target_update_every and self.grad_steps % self.target_update_every == 0:
+            self.sync_target()
\ No newline at end of file
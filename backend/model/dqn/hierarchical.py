@@ -0,0 +1,267 @@
+# hierarchical.py
+import argparse
+import math
+import os
+import time
+
+import networkx as nx
+import numpy as np
+from scipy.cluster.vq import kmeans2
+
+from model.dqn.allocation_env import LINK_REWARDS, link_edges, sub_link_matrix
+from model.dqn.train_predict import returnEnvAndAgent, greedy_pass
+from model.dqn.train_predict import build_allocation_summary, printSummary, print_link_summary
+from model.dqn.local_search import refine_allocation
+from model.dqn.multi_start import get_allocation_pool, start_allocation_pool
+from model.registry import SHARED_DQN_CHECKPOINT
+
+
+def graph_communities(E, num_students, seed=0):
+    """
+    Louvain communities of the undirected graph of positive links
+    (disrespect links are ignored). Returns an (N,) community id array.
+    """
+    src, dst, lbl = link_edges(E)
+    keep = (LINK_REWARDS[lbl] > 0) & (src != dst)
+    G = nx.Graph()
+    G.add_nodes_from(range(num_students))
+    G.add_edges_from(zip(src[keep].tolist(), dst[keep].tolist()))
+    labels = np.empty(num_students, dtype=np.int64)
+    for k, members in enumerate(nx.community.louvain_communities(G, seed=seed)):
+        labels[list(members)] = k
+    return labels
+
+
+def _split_chunks(members, student_data, max_chunk, seed):
+    """Splits a community larger than max_chunk by k-means on the student features."""
+    if len(members) <= max_chunk:
+        return [members]
+    k = math.ceil(len(members) / max_chunk)
+    _, labels = kmeans2(student_data[members].astype(np.float64), k, minit='++', seed=seed)
+    chunks = []
+    for c in range(k):
+        group = members[labels == c]
+        # k-means clusters are not size-bounded; cut any that are still too big
+        chunks.extend(np.array_split(group, math.ceil(len(group) / max_chunk)) if len(group) else [])
+    return chunks
+
+
+def partition_cohort(student_data, E, block_sizes, seed=0):
+    """
+    Partitions a cohort into blocks of exactly `block_sizes` students.
+
+    Friendship communities are kept together where possible: communities
+    are split by feature k-means only when they exceed a quarter of the
+    smallest block. Chunks are placed largest first into the block that
+    keeps both its fill ratio and its feature mean's distance from the
+    cohort mean lowest, so every block resembles the whole cohort.
+
+    Returns:
+      (N,) block index per student
+    """
+    X = np.asarray(student_data, dtype=np.float64)
+    block_sizes = np.asarray(block_sizes, dtype=np.int64)
+    num_blocks = len(block_sizes)
+    communities = graph_communities(E, len(X), seed)
+
+    max_chunk = max(1, int(block_sizes.min()) // 4)
+    order = np.argsort(communities, kind='stable')
+    bounds = np.flatnonzero(np.diff(communities[order])) + 1
+    chunks = []
+    for members in np.split(order, bounds):
+        chunks.extend(_split_chunks(members, X, max_chunk, seed))
+    chunks.sort(key=len, reverse=True)
+
+    mu = X.mean(axis=0)
+    mu_norm = np.linalg.norm(mu) + 1e-6
+    counts = np.zeros(num_blocks, dtype=np.int64)
+    sums = np.zeros((num_blocks, X.shape[1]))
+    blocks = np.empty(len(X), dtype=np.int64)
+    for chunk in chunks:
+        while len(chunk):
+            room = block_sizes - counts
+            fits = room >= len(chunk)
+            if not fits.any():
+                # no block takes the whole chunk: fill the roomiest one with part of it
+                b = int(np.argmax(room))
+                part, chunk = chunk[:room[b]], chunk[room[b]:]
+            else:
+                n_after = counts + len(chunk)
+                avg_after = (sums + X[chunk].sum(axis=0)) / n_after[:, None]
+                score = (n_after / block_sizes +
+                         np.linalg.norm(avg_after - mu, axis=1) / mu_norm)
+                b = int(np.argmin(np.where(fits, score, np.inf)))
+                part, chunk = chunk, chunk[:0]
+            blocks[part] = b
+            counts[b] += len(part)
+            sums[b] += X[part].sum(axis=0)
+    return blocks
+
+
+def _block_worker(job):
+    """Allocates one block into its own classes inside a worker process."""
+    student_data = job['student_data']
+    env, agent = returnEnvAndAgent(student_data, job['num_classes'], job['target_class_size'],
+                                   job['target_feature_avgs'], job['E'], job['model_path'])
+    order = np.random.default_rng(job['seed']).permutation(len(student_data))
+    greedy_pass(student_data, env, agent, order)
+    if job['refine_ms']:
+        refine_allocation(env, student_data, time_budget_ms=job['refine_ms'], seed=job['seed'])
+    return job['block'], env.assignment.copy()
+
+
+def _block_model_path(num_classes, model_path):
+    if model_path:
+        return model_path
+    if os.path.exists(SHARED_DQN_CHECKPOINT):
+        return SHARED_DQN_CHECKPOINT
+    return f"model/dqn/d{num_classes}.pth"
+
+
+def block_class_counts(num_classes, classes_per_block, model_path=None):
+    """
+    Splits `num_classes` into per-block class counts close to
+    `classes_per_block`.
+
+    With `model_path` or the shared policy on disk any count can be
+    allocated, so the classes are split evenly. Otherwise only counts
+    with a d{n}.pth checkpoint are used, choosing the combination whose
+    counts deviate least from `classes_per_block` in total.
+
+    Raises:
+      ValueError if no combination of available checkpoints adds up to
+      `num_classes`
+    """
+    if model_path or os.path.exists(SHARED_DQN_CHECKPOINT):
+        num_blocks = max(1, math.ceil(num_classes / classes_per_block))
+        return [len(c) for c in np.array_split(np.arange(num_classes), num_blocks)]
+
+    available = [k for k in range(2, num_classes + 1) if os.path.exists(f"model/dqn/d{k}.pth")]
+    # best[n] = (total deviation, counts) of the cheapest split of n classes
+    best = [(0, [])] + [None] * num_classes
+    for n in range(1, num_classes + 1):
+        for k in available:
+            if k <= n and best[n - k] is not None:
+                cost = best[n - k][0] + abs(k - classes_per_block)
+                if best[n] is None or cost < best[n][0]:
+                    best[n] = (cost, best[n - k][1] + [k])
+    if best[num_classes] is None:
+        raise ValueError(f"Cannot split {num_classes} classes into blocks with a checkpoint "
+                         f"(available class counts: {available}); train {SHARED_DQN_CHECKPOINT} "
+                         f"or pass model_path")
+    return sorted(best[num_classes][1], reverse=True)
+
+
+def allocate_hierarchical(student_data, env, unit_id, E, target_class_size, target_feature_avgs,
+                          classes_per_block=6, model_path=None, seed=0, refine_ms=0):
+    """
+    Allocates a large cohort block by block.
+
+    The cohort is partitioned (partition_cohort) into blocks that each get
+    about `classes_per_block` of the classes and a proportional share of
+    the students; without the shared policy the block class counts are
+    limited to those with a d{n}.pth checkpoint (block_class_counts).
+    Every block is allocated independently in the shared
+    worker pool on its own subgraph of E, so memory and time grow with the
+    block size rather than the cohort size. Block labels are then offset
+    into the cohort's class ids and the merged allocation is loaded into
+    `env`. Blocks use d{n}.pth when it exists for their class count and
+    the shared policy otherwise, unless `model_path` is given.
+
+    Raises:
+      ValueError if the classes cannot be split into blocks with a checkpoint
+
+    Returns:
+      allocation_summary -- as for allocate_with_existing_model
+      info               -- dict with block sizes, classes per block and runtime
+    """
+    X = np.asarray(student_data)
+    num_students = len(X)
+    num_classes = env.num_classes
+    counts = block_class_counts(num_classes, classes_per_block, model_path)
+    num_blocks = len(counts)
+    block_classes = np.split(np.arange(num_classes), np.cumsum(counts)[:-1])
+
+    # students per block in proportion to its classes, remainder spread over the first blocks
+    shares = np.array([len(c) for c in block_classes]) * num_students / num_classes
+    block_sizes = np.floor(shares).astype(np.int64)
+    block_sizes[:num_students - block_sizes.sum()] += 1
+
+    start = time.perf_counter()
+    print(f"\n---------------- Hierarchical allocation: {num_students} students, "
+          f"{num_classes} classes in {num_blocks} blocks")
+    blocks = partition_cohort(X, E, block_sizes, seed)
+    partition_seconds = time.perf_counter() - start
+
+    jobs, members = [], []
+    for b, classes in enumerate(block_classes):
+        nodes = np.flatnonzero(blocks == b)
+        members.append(nodes)
+        jobs.append({
+            'block':               b,
+            'student_data':        X[nodes],
+            'E':                   sub_link_matrix(E, nodes),
+            'num_classes':         len(classes),
+            'target_class_size':   math.ceil(len(nodes) / len(classes)),
+            'target_feature_avgs': np.asarray(target_feature_avgs)[classes],
+            'model_path':          _block_model_path(len(classes), model_path),
+            'seed':                seed + b,
+            'refine_ms':           refine_ms,
+        })
+
+    pool = get_allocation_pool()
+    labels = np.full(num_students, -1, dtype=np.int64)
+    for b, block_labels in pool.map(_block_worker, jobs):
+        labels[members[b]] = block_classes[b][block_labels]
+
+    env.load_assignment(labels, X)
+    allocation_summary = build_allocation_summary(env, env.target_feature_avgs, unit_id, E)
+    printSummary(env, env.target_feature_avgs)
+    print_link_summary(env, env.E)
+
+    info = {
+        'blocks':            [int(len(m)) for m in members],
+        'classes_per_block': [int(len(c)) for c in block_classes],
+        'partition_seconds': round(partition_seconds, 3),
+        'seconds':           round(time.perf_counter() - start, 3),
+    }
+    return allocation_summary, info
+
+
+if __name__ == "__main__":
+    from database.db import SessionLocal
+    from model.dqn.allocation_env import StudentAllocationEnv, precompute_link_matrices
+    from model.dqn.train_parallel import default_target_matrix
+    from model.unit_cache import unit_cache
+    from model_utils import load_unit_graph, save_allocations, save_allocation_summary
+
+    parser = argparse.ArgumentParser(description="Allocate a large cohort block by block.")
+    parser.add_argument("--unit-id", type=int, required=True)
+    parser.add_argument("--num-classes", type=int, required=True)
+    parser.add_argument("--classes-per-block", type=int, default=6)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--refine-ms", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", action="store_true", help="write the allocation to the database")
+    args = parser.parse_args()
+    start_allocation_pool(workers=args.workers)
+
+    db = SessionLocal()
+    try:
+        data, id_map = load_unit_graph(db, args.unit_id)
+        student_data = data.x.cpu().numpy()
+        E = precompute_link_matrices(data)
+        target_class_size = math.ceil(len(student_data) / args.num_classes)
+        targets = default_target_matrix(student_data, args.num_classes)
+        env = StudentAllocationEnv(args.num_classes, target_class_size, targets, E)
+        summary, info = allocate_hierarchical(student_data, env, args.unit_id, E, target_class_size, targets,
+                                              classes_per_block=args.classes_per_block,
+                                              seed=args.seed, refine_ms=args.refine_ms)
+        print(f"\n---------------- {info}")
+        if args.save:
+            save_allocation_summary(args.unit_id, summary, db)
+            upserted = save_allocations(db, env, id_map, args.unit_id)
+            unit_cache.invalidate(args.unit_id)
+            print(f"---------------- Saved {upserted} allocations")
+    finally:
+        db.close()
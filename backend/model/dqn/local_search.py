@@ -0,0 +1,175 @@
+# local_search.py
+import time
+
+import numpy as np
+
+from model.dqn.allocation_env import LINK_REWARDS, NO_LINK_PENALTY, OVERFILL_PENALTY
+from model.dqn.allocation_env import in_links, out_links, link_edges
+
+# link weight relative to "no link", so absent pairs contribute nothing to P
+_LINK_GAIN = LINK_REWARDS - NO_LINK_PENALTY
+
+
+class LocalSearchState:
+    def __init__(self, assignment, student_data, num_classes, target_class_size,
+                 target_feature_avgs, E):
+        """
+        Incrementally maintained allocation objective for local search.
+
+        The objective keeps the terms of StudentAllocationEnv.compute_reward
+        for a complete allocation:
+          size     -Σ_c |n_c - T| / T
+          features -2 Σ_c ||avg_c - tgt_c|| / ||tgt_c||
+          links    each same-class pair scores the mean of its two directed
+                   link rewards (NO_LINK_PENALTY when unlinked)
+        plus the over-fill penalty from step().
+
+        `P[s, c]` sums the link gains between s and the members of c in both
+        directions, so a move is scored in O(C * D) and applied in O(degree).
+        """
+        self.X = np.asarray(student_data, dtype=np.float64)
+        self.E = E
+        self.num_classes = num_classes
+        self.T = target_class_size
+        self.targets = np.asarray(target_feature_avgs, dtype=np.float64)
+        self.target_norms = np.linalg.norm(self.targets, axis=1) + 1e-6
+
+        self.labels = np.asarray(assignment, dtype=np.int64).copy()
+        self.counts = np.bincount(self.labels, minlength=num_classes)
+        self.sums = np.zeros((num_classes, self.X.shape[1]))
+        np.add.at(self.sums, self.labels, self.X)
+        self.feat = self._feature_terms(self.sums, self.counts)
+
+        self.P = np.zeros((len(self.labels), num_classes))
+        src, dst, lbl = link_edges(E)
+        keep = src != dst
+        src, dst, gain = src[keep], dst[keep], _LINK_GAIN[lbl[keep]]
+        np.add.at(self.P, (src, self.labels[dst]), gain)
+        np.add.at(self.P, (dst, self.labels[src]), gain)
+
+    def _feature_terms(self, sums, counts, classes=None):
+        tgt = self.targets if classes is None else self.targets[classes]
+        norms = self.target_norms if classes is None else self.target_norms[classes]
+        avg = sums / np.maximum(counts, 1)[..., None]
+        return np.linalg.norm(avg - tgt, axis=-1) / norms
+
+    def _size_terms(self, counts):
+        return (np.abs(counts - self.T) / self.T +
+                OVERFILL_PENALTY * np.maximum(counts - self.T, 0))
+
+    def objective(self):
+        """Current objective value (higher is better)."""
+        own = self.P[np.arange(len(self.labels)), self.labels]
+        links = 0.25 * own.sum() + NO_LINK_PENALTY * 0.5 * (self.counts * (self.counts - 1)).sum()
+        return float(-self._size_terms(self.counts).sum() - 2 * self.feat.sum() + links)
+
+    def _pair_score(self, s, t):
+        w_st, w_ts = int(self.E[s, t]), int(self.E[t, s])
+        g = 0.0
+        if 0 <= w_st < len(_LINK_GAIN):
+            g += _LINK_GAIN[w_st]
+        if 0 <= w_ts < len(_LINK_GAIN):
+            g += _LINK_GAIN[w_ts]
+        return 0.5 * g + NO_LINK_PENALTY
+
+    def _link_to(self, s, c, exclude_self):
+        n = self.counts[c] - (1 if exclude_self else 0)
+        return 0.5 * self.P[s, c] + NO_LINK_PENALTY * n
+
+    def move_deltas(self, s):
+        """Objective change of moving s into every class, shape (num_classes,)."""
+        a = self.labels[s]
+        x = self.X[s]
+        n = self.counts
+
+        # size and over-fill terms of class a (losing s) and each b (gaining s)
+        size_a = self._size_terms(n[a] - 1) - self._size_terms(n[a])
+        size_b = self._size_terms(n + 1) - self._size_terms(n)
+
+        feat_a = self._feature_terms(self.sums[a] - x, n[a] - 1, a) - self.feat[a]
+        feat_b = self._feature_terms(self.sums + x, n + 1) - self.feat
+
+        link_b = 0.5 * self.P[s] + NO_LINK_PENALTY * n
+        link_a = self._link_to(s, a, exclude_self=True)
+
+        delta = -(size_a + size_b) - 2 * (feat_a + feat_b) + (link_b - link_a)
+        delta[a] = 0.0
+        return delta
+
+    def swap_delta(self, s, t):
+        """Objective change of swapping s and t (in different classes)."""
+        a, b = self.labels[s], self.labels[t]
+        dx = self.X[t] - self.X[s]
+        new_a = self._feature_terms(self.sums[a] + dx, self.counts[a], a)
+        new_b = self._feature_terms(self.sums[b] - dx, self.counts[b], b)
+        feat = (new_a - self.feat[a]) + (new_b - self.feat[b])
+
+        link = (self._link_to(s, b, False) - self._link_to(s, a, True) +
+                self._link_to(t, a, False) - self._link_to(t, b, True) -
+                2 * self._pair_score(s, t))
+        return float(-2 * feat + link)
+
+    def apply_move(self, s, b):
+        """Moves s into class b, updating every cached term."""
+        a = self.labels[s]
+        if a == b:
+            return
+        x = self.X[s]
+        self.sums[a] -= x
+        self.sums[b] += x
+        self.counts[a] -= 1
+        self.counts[b] += 1
+        self.labels[s] = b
+        self.feat[[a, b]] = self._feature_terms(self.sums[[a, b]], self.counts[[a, b]], [a, b])
+
+        for nbrs, lbl in (out_links(self.E, s), in_links(self.E, s)):
+            keep = nbrs != s
+            nbrs, gain = nbrs[keep], _LINK_GAIN[lbl[keep]]
+            self.P[nbrs, a] -= gain
+            self.P[nbrs, b] += gain
+
+    def apply_swap(self, s, t):
+        a, b = self.labels[s], self.labels[t]
+        self.apply_move(s, b)
+        self.apply_move(t, a)
+
+
+def refine_allocation(env, student_data, time_budget_ms=200, swap_prob=0.5, seed=None):
+    """
+    Improves the allocation held in `env` with single moves and pairwise
+    swaps between classes until the time budget runs out. Only improving
+    moves are accepted. The refined allocation is written back into `env`.
+
+    Returns:
+      dict with the initial and final objective and the number of
+      accepted moves and swaps
+    """
+    rng = np.random.default_rng(seed)
+    state = LocalSearchState(env.assignment, student_data, env.num_classes,
+                             env.target_class_size, env.target_feature_avgs, env.E)
+    initial = state.objective()
+    num_students = len(state.labels)
+    moves = swaps = 0
+
+    deadline = time.perf_counter() + time_budget_ms / 1000.0
+    while time.perf_counter() < deadline:
+        s = int(rng.integers(num_students))
+        if rng.random() < swap_prob:
+            t = int(rng.integers(num_students))
+            if state.labels[s] == state.labels[t]:
+                continue
+            if state.swap_delta(s, t) > 1e-9:
+                state.apply_swap(s, t)
+                swaps += 1
+        else:
+            delta = state.move_deltas(s)
+            b = int(np.argmax(delta))
+            if delta[b] > 1e-9:
+                state.apply_move(s, b)
+                moves += 1
+
+    env.load_assignment(state.labels, student_data)
+    result = {'initial': initial, 'final': state.objective(), 'moves': moves, 'swaps': swaps}
+    print(f"\n---------------- Local search: objective {initial:.2f} -> {result['final']:.2f} "
+          f"({moves} moves, {swaps} swaps)")
+    return result
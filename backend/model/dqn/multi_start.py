@@ -0,0 +1,203 @@
+# multi_start.py
+import multiprocessing as mp
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import torch
+
+from model.dqn.train_predict import returnEnvAndAgent, greedy_pass, INFERENCE_THREADS
+from model.dqn.train_predict import build_allocation_summary, printSummary, print_link_summary
+from model.dqn.local_search import refine_allocation
+from model.dqn.allocation_objective import evaluate_allocation
+from model.registry import get_dqn_inference
+
+# weight of the summed per-class feature deviation against the env reward
+FEATURE_DEVIATION_WEIGHT = 100.0
+
+# size of the shared worker pool, fixed for the life of the process; every
+# worker imports torch and loads the checkpoints, so keep the default small
+ALLOCATION_WORKERS = int(os.environ.get("ALLOCATION_WORKERS", min(2, os.cpu_count() or 1)))
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    torch.set_num_threads(INFERENCE_THREADS)
+
+
+def _warm_worker(model_paths):
+    """Loads the given checkpoints into a worker's model registry."""
+    for path in model_paths:
+        if os.path.exists(path):
+            get_dqn_inference(path)
+    # hold the worker briefly so the other warm-up jobs land on other workers
+    time.sleep(0.5)
+    return os.getpid()
+
+
+def _create_pool(workers):
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None:
+            _pool_workers = workers or ALLOCATION_WORKERS
+            # spawn keeps workers clear of the parent's torch thread pool
+            _pool = ProcessPoolExecutor(max_workers=_pool_workers, mp_context=mp.get_context("spawn"),
+                                        initializer=_init_worker)
+        return _pool
+
+
+def start_allocation_pool(model_paths=(), workers=None):
+    """
+    Creates the shared worker pool with `workers` processes (default
+    ALLOCATION_WORKERS) if it does not exist yet, then starts every worker
+    and preloads `model_paths` in each. Call it once at startup; the pool
+    keeps its size afterwards, so requests never tear it down.
+    """
+    pool = _create_pool(workers)
+    start = time.perf_counter()
+    jobs = [pool.submit(_warm_worker, tuple(model_paths)) for _ in range(_pool_workers)]
+    pids = set()
+    for f in jobs:
+        try:
+            pids.add(f.result())
+        except Exception as e:
+            print(f"\n------------ Allocation worker failed to warm up: {e!r}")
+            if isinstance(e, BrokenProcessPool):
+                _discard_pool(pool)
+                break
+    print(f"\n------------ Allocation pool ready: {len(pids)}/{len(jobs)} workers warmed in "
+          f"{time.perf_counter() - start:.2f}s")
+    return pool
+
+
+def _discard_pool(pool):
+    """Drops a broken pool so that the next request creates a fresh one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def get_allocation_pool():
+    """
+    Returns the shared worker pool, creating it (without warming) on first
+    use. Workers keep their own model registry, so each checkpoint is
+    loaded once per worker rather than once per request.
+    """
+    return _pool if _pool is not None else _create_pool(None)
+
+
+def _score(student_data, job, order, labels, reward):
+    """Result record of one start: its env reward minus the weighted feature deviation."""
+    evaluation = evaluate_allocation(labels, student_data, job['num_classes'],
+                                     job['target_class_size'], job['target_feature_avgs'], job['E'])
+    deviation = float(evaluation['feature_error'].sum())
+    return {
+        'seed':      job['seed'],
+        'order':     order,
+        'labels':    labels,
+        'reward':    reward,
+        'deviation': deviation,
+        'score':     reward - FEATURE_DEVIATION_WEIGHT * deviation,
+    }
+
+
+def _start_worker(job):
+    """Runs one greedy pass over a seeded random ordering inside a worker process."""
+    student_data = job['student_data']
+    env, agent = returnEnvAndAgent(student_data, job['num_classes'], job['target_class_size'],
+                                   job['target_feature_avgs'], job['E'], job['model_path'])
+    order = np.random.default_rng(job['seed']).permutation(len(student_data))
+    reward = greedy_pass(student_data, env, agent, order, stop_at=job['stop_at'])
+    if reward is None:
+        return None
+    return _score(student_data, job, order, env.assignment.copy(), float(reward))
+
+
+def allocate_multi_start(student_data, env, agent, unit_id, E, target_class_size, target_feature_avgs,
+                         model_path, num_starts=8, deadline=5.0, seed=None, refine_ms=0):
+    """
+    Runs `num_starts` greedy passes over independent random orderings in
+    the shared worker pool and loads the best one into `env`.
+
+    Each start is scored by its total env reward minus
+    FEATURE_DEVIATION_WEIGHT times its per-class feature deviation. The
+    result is taken `deadline` seconds after the call: queued starts are
+    cancelled and running ones abandon their pass at the deadline, so
+    they free their workers. Starts that raise are skipped. If no start
+    has finished by then, one pass with `agent` runs in this process
+    instead.
+
+    Returns:
+      allocation_summary -- summary of the best start
+      info               -- dict with the number of submitted and finished
+                            starts, the best seed and every finished score
+    """
+    base = np.random.SeedSequence(seed).generate_state(num_starts)
+    job = {
+        'student_data':        student_data,
+        'num_classes':         env.num_classes,
+        'target_class_size':   target_class_size,
+        'target_feature_avgs': target_feature_avgs,
+        'E':                   E,
+        'model_path':          model_path,
+    }
+    print(f"\n---------------- Multi-start allocation: {num_starts} starts, deadline {deadline}s")
+    start = time.perf_counter()
+    job['stop_at'] = time.time() + deadline
+    pool = get_allocation_pool()
+    try:
+        futures = [pool.submit(_start_worker, dict(job, seed=int(s))) for s in base]
+    except BrokenProcessPool as e:
+        print(f"---------------- Allocation pool is broken: {e!r}")
+        _discard_pool(pool)
+        futures = []
+
+    done, pending = wait(futures, timeout=max(0.0, deadline - (time.perf_counter() - start)))
+    for f in pending:
+        f.cancel()
+
+    # a failed start is skipped; a dead worker breaks the pool, which is replaced
+    results = []
+    for f in done:
+        try:
+            result = f.result()
+        except Exception as e:
+            print(f"---------------- Start failed: {e!r}")
+            if isinstance(e, BrokenProcessPool):
+                _discard_pool(pool)
+            continue
+        if result is not None:
+            results.append(result)
+    if not results:
+        print("---------------- No start finished in time or all failed, running one pass here")
+        order = np.random.default_rng(int(base[0])).permutation(len(student_data))
+        reward = float(greedy_pass(student_data, env, agent, order))
+        results = [_score(student_data, dict(job, seed=int(base[0])), order, env.assignment.copy(), reward)]
+    best = max(results, key=lambda r: r['score'])
+    env.load_assignment(best['labels'], student_data, best['order'])
+    print(f"---------------- Best of {len(results)}/{num_starts} starts: seed {best['seed']}, "
+          f"reward {best['reward']:.2f}, deviation {best['deviation']:.4f}")
+
+    if refine_ms:
+        refine_allocation(env, student_data, time_budget_ms=refine_ms)
+
+    allocation_summary = build_allocation_summary(env, env.target_feature_avgs, unit_id, E)
+    printSummary(env, env.target_feature_avgs)
+    print_link_summary(env, env.E)
+
+    info = {
+        'submitted': num_starts,
+        'finished':  len(results),
+        'best_seed': best['seed'],
+        'scores':    sorted((round(r['score'], 2) for r in results), reverse=True),
+        'seconds':   round(time.perf_counter() - start, 3),
+    }
+    return allocation_summary, info
@@ -0,0 +1,166 @@
+# train_parallel.py
+import argparse
+import math
+import multiprocessing as mp
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from model.dqn.train_predict import train_agent, train_shared_policy
+from model.dqn.allocation_env import precompute_link_matrices
+
+
+def default_target_matrix(student_data, num_classes):
+    """Every class targets the unit-wide feature averages."""
+    return np.tile(student_data.mean(axis=0).round(2), (num_classes, 1))
+
+
+def _train_worker(job):
+    """Trains one (num_classes, seed) run inside a worker process."""
+    torch.set_num_threads(job['threads'])
+    random.seed(job['seed'])
+    np.random.seed(job['seed'])
+    torch.manual_seed(job['seed'])
+
+    student_data = job['student_data']
+    num_classes = job['num_classes']
+    target_class_size = math.ceil(student_data.shape[0] / num_classes)
+    agent, rewards = train_agent(num_classes,
+                                 target_class_size,
+                                 job['target_feature_avgs'],
+                                 student_data,
+                                 job['E'],
+                                 num_episodes=job['num_episodes'],
+                                 batch_size=job['batch_size'],
+                                 num_envs=job['num_envs'],
+                                 verbose=False)
+    return {
+        'num_classes': num_classes,
+        'seed':        job['seed'],
+        'rewards':     rewards,
+        'state_dict':  agent.model.state_dict(),
+    }
+
+
+def train_all_checkpoints(student_data, E,
+                          class_counts=(5, 7, 9),
+                          seeds=(0,),
+                          num_episodes=250,
+                          batch_size=32,
+                          num_envs=8,
+                          workers=None,
+                          threads_per_worker=None,
+                          target_feature_avgs=None,
+                          model_dir="model/dqn",
+                          score_window=20):
+    """
+    Trains every (class count, seed) combination in parallel worker
+    processes and keeps the best run per class count as d{n}.pth.
+
+    Runs are ranked by their mean total reward over the last
+    `score_window` episodes. Each worker limits torch to
+    `threads_per_worker` intra-op threads so the pool does not
+    oversubscribe the machine.
+
+    Args:
+      student_data: (N x feature_dim) feature matrix
+      E: link store from precompute_link_matrices
+      target_feature_avgs: optional dict {num_classes: (num_classes x feature_dim)};
+                           defaults to the unit-wide averages for every class
+
+    Returns:
+      dict with 'runs' (per-run reward curves) and 'best'
+      ({num_classes: {'seed', 'score', 'path'}})
+    """
+    cpus = os.cpu_count() or 1
+    jobs = [(n, seed) for n in class_counts for seed in seeds]
+    if workers is None:
+        workers = min(len(jobs), cpus)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, cpus // workers)
+    target_feature_avgs = target_feature_avgs or {}
+
+    payloads = [{
+        'num_classes':         n,
+        'seed':                seed,
+        'threads':             threads_per_worker,
+        'student_data':        student_data,
+        'E':                   E,
+        'target_feature_avgs': target_feature_avgs.get(n, default_target_matrix(student_data, n)),
+        'num_episodes':        num_episodes,
+        'batch_size':          batch_size,
+        'num_envs':            num_envs,
+    } for n, seed in jobs]
+
+    print(f"\n---------------- Training {len(jobs)} runs on {workers} workers "
+          f"x {threads_per_worker} threads")
+    # spawn keeps workers clear of the parent's torch thread pool
+    ctx = mp.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        results = list(pool.map(_train_worker, payloads))
+
+    runs, best = [], {}
+    for res in results:
+        score = float(np.mean(res['rewards'][-score_window:]))
+        runs.append({'num_classes': res['num_classes'], 'seed': res['seed'],
+                     'score': score, 'rewards': res['rewards']})
+        print(f"Classes {res['num_classes']}, seed {res['seed']}: score = {score:.2f}")
+        n = res['num_classes']
+        if n not in best or score > best[n]['score']:
+            best[n] = {'seed': res['seed'], 'score': score, 'state_dict': res['state_dict']}
+
+    for n, b in best.items():
+        path = os.path.join(model_dir, f"d{n}.pth")
+        torch.save(b.pop('state_dict'), path)
+        b['path'] = path
+        print(f"---------------- Saved best {n}-class model (seed {b['seed']}) to {path}")
+
+    return {'runs': runs, 'best': best}
+
+
+if __name__ == "__main__":
+    from database.db import SessionLocal
+    from model_utils import load_unit_graph, load_csv_graph
+
+    parser = argparse.ArgumentParser(description="Train the per-class-count DQN checkpoints in parallel.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--unit-id", type=int)
+    source.add_argument("--csv", action="store_true",
+                        help="train on data/survey_responses.csv and data/relationships.csv instead of a unit")
+    parser.add_argument("--classes", type=int, nargs="+", default=[5, 7, 9])
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--episodes", type=int, default=250)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--model-dir", default="model/dqn")
+    parser.add_argument("--shared", action="store_true",
+                        help="train one class-count-agnostic model (shared.pth) over --classes instead")
+    args = parser.parse_args()
+
+    if args.csv:
+        data, _ = load_csv_graph()
+    else:
+        db = SessionLocal()
+        try:
+            data, _ = load_unit_graph(db, args.unit_id)
+        finally:
+            db.close()
+
+    if args.shared:
+        train_shared_policy(data.x.cpu().numpy(),
+                            precompute_link_matrices(data),
+                            class_counts=args.classes,
+                            episodes_per_count=args.episodes,
+                            model_path=os.path.join(args.model_dir, "shared.pth"))
+    else:
+        train_all_checkpoints(data.x.cpu().numpy(),
+                              precompute_link_matrices(data),
+                              class_counts=args.classes,
+                              seeds=args.seeds,
+                              num_episodes=args.episodes,
+                              workers=args.workers,
+                              threads_per_worker=args.threads_per_worker,
+                              model_dir=args.model_dir)
@@ -1,12 +1,20 @@
 # train_predict.py
 import numpy as np
 import random
+import time
 import torch
 
-from model.dqn.dqn_agent import DQNAgent
+from model.dqn.dqn_agent import DQNAgent, SharedClassDQN
 from model.dqn.allocation_env import StudentAllocationEnv
-from model.dqn.allocation_env import state_to_vector
+from model.dqn.allocation_env import VecAllocationEnv
 from model.dqn.allocation_env import precompute_link_matrices
+from model.dqn.allocation_env import link_counts_by_class
+from model.dqn.local_search import refine_allocation
+from model.milp.milp_allocator import solve_allocation_milp
+from model.registry import get_dqn, get_dqn_inference
+
+# torch intra-op threads of a web or allocation-pool worker, set once at startup
+INFERENCE_THREADS = 1
 
 def print_link_summary(env, E):
     """
@@ -15,8 +23,9 @@ def print_link_summary(env, E):
     Args:
       env: your allocation environment, with:
         - env.num_classes
-        - env.state[cls_idx]['student_indices']  (list of student indices)
-      E:   (N x N) numpy array of integer edge‐labels.
+        - env.members[cls_idx]  (list of student indices)
+      E:   link store from precompute_link_matrices: a dense (N x N) array
+           of integer edge‐labels or a SparseLinkMatrix.
            Valid labels: 0=friends, 1=influential, 2=feedback, 3=more_time,
                          4=advice, 5=disrespect
            Any other value (e.g. -1 or >5) will be ignored.
@@ -37,56 +46,35 @@ def print_link_summary(env, E):
     # CSV header
     print("Class," + ",".join(labels))
 
-    # for each class
+    # per-class, per-label counts of edges among members in one pass
+    counts = link_counts_by_class(E, env.assignment, env.num_classes)
     for cls_idx in range(env.num_classes):
-        counts = {lbl: 0 for lbl in labels}
-        members = env.state[cls_idx]['student_indices']
-
-        # count edges among members
-        for i in members:
-            for j in members:
-                if i == j:
-                    continue
-                val = int(E[i, j])
-                # only count if it's one of our six labels
-                if val in rev:
-                    counts[rev[val]] += 1
-
-        # print CSV row
-        row = ",".join(str(counts[lbl]) for lbl in labels)
+        row = ",".join(str(c) for c in counts[cls_idx])
         print(f"{cls_idx},{row}")
 
 
 def build_allocation_summary(env, target_feature_avgs, unit_id,E):
     """
-    Walks env.state to build a list of dicts, one per class,
+    Walks the env class arrays to build a list of dicts, one per class,
     with all the metrics you need for AllocationsSummary.
+    E may be a dense link matrix or a SparseLinkMatrix.
     """
     summary = []
-    # first get the link counts from your utility
-    # but here we re-compute them into dicts:
-    friends, influence, feedback, more_time, advice, disrespect = ([] for _ in range(6))
-    # reuse the same logic from print_link_summary but accumulating into lists per class
-    edge_types = {'friends':0,'influence':1,'feedback':2,'more_time':3,
-                  'advice':4,'disrespect':5, 'no_link':-1}
-    rev = {v:k for k,v in edge_types.items()}
-    # precompute both existing and predicted per class into two lists of dicts
+    edge_types = ['friends','influence','feedback','more_time','advice','disrespect']
+    # per-class, per-label counts of edges among members in one pass
+    link_counts = link_counts_by_class(E, env.assignment, env.num_classes)
     existing_counts_list = []
     for cls_idx in range(env.num_classes):
-        members = env.state[cls_idx]['student_indices']
-        exc = {lbl:0 for lbl in edge_types}
-        for i in members:
-            for j in members:
-                if i==j: continue
-                lbl = int(E[i,j])
-                exc[rev[lbl]] += 1
+        exc = {lbl: int(link_counts[cls_idx, k]) for k, lbl in enumerate(edge_types)}
+        n = int(env.counts[cls_idx])
+        exc['no_link'] = n * (n - 1) - int(link_counts[cls_idx].sum())
         existing_counts_list.append(exc)
 
     # now build per-class rows
     for i, tgt in enumerate(target_feature_avgs):
-        cnt = env.state[i]['count']
+        cnt = env.counts[i]
         if cnt>0:
-            avg = (env.state[i]['sum_features']/cnt).round(3)
+            avg = (env.sum_features[i]/cnt).round(3)
         else:
             avg = [0.0]*len(tgt)
 
@@ -128,6 +116,118 @@ def build_allocation_summary(env, target_feature_avgs, unit_id,E):
     return summary
 
 
+def train_agent(num_classes,
+                target_class_size,
+                target_feature_avgs,
+                student_data,
+                E,
+                num_episodes=250,
+                batch_size=32,
+                num_envs=8,
+                verbose=True,
+                model=None):
+    """
+    Trains a DQN allocation policy on one unit.
+
+    Episodes run `num_envs` at a time in a VecAllocationEnv, so each step
+    picks actions for all of them with one forward pass. Full classes are
+    masked out of both the action choice and the bootstrap target. Pass a
+    SharedClassDQN as `model` to keep training a class-count-agnostic
+    policy; by default a fresh per-count DQN is trained.
+
+    Returns:
+      agent   -- the trained DQNAgent
+      rewards -- list of total rewards, one per episode
+    """
+    feature_dim = student_data.shape[1]
+    state_dim = num_classes * (2 + 2*feature_dim)
+    action_dim = num_classes
+
+    vec_env = VecAllocationEnv(num_envs,
+                               num_classes,
+                               target_class_size,
+                               target_feature_avgs,
+                               E,
+                               student_data)
+    agent = DQNAgent(state_dim, action_dim, model=model)
+
+    rewards = []
+    for first_ep in range(0, num_episodes, num_envs):
+        s = vec_env.reset()
+        total_reward = np.zeros(num_envs)
+        done = False
+        masks = vec_env.action_masks()
+        while not done:
+            a = agent.act_batch(s, masks)
+            r, done = vec_env.step(a)
+            total_reward += r
+            s_next = vec_env.get_state()
+            masks = vec_env.action_masks()
+            agent.remember_batch(s, a, r, s_next, done, masks)
+            agent.train_step(batch_size, n_transitions=num_envs)
+            s = s_next
+        for k in range(min(num_envs, num_episodes - first_ep)):
+            ep = first_ep + k
+            rewards.append(float(total_reward[k]))
+            if verbose and ep % 10 == 0:
+                print(f"Episode {ep+1:03d}: Total Reward = {total_reward[k]:.2f}, Epsilon = {agent.epsilon:.3f}")
+    if verbose:
+        print(f"\n---------------- Training completed after {num_episodes} episodes.")
+    return agent, rewards
+
+
+def train_shared_policy(student_data,
+                        E,
+                        class_counts=(5, 6, 7, 8, 9),
+                        num_rounds=2,
+                        episodes_per_count=50,
+                        batch_size=32,
+                        num_envs=8,
+                        target_feature_avgs=None,
+                        model_path=None,
+                        verbose=True):
+    """
+    Trains one SharedClassDQN across several class counts by cycling
+    through `class_counts` for `num_rounds` rounds. Every count gets its
+    own agent and replay buffer (state widths differ) around the shared
+    weights.
+
+    Args:
+      target_feature_avgs: optional dict {num_classes: (num_classes x feature_dim)};
+                           defaults to the unit-wide averages for every class
+
+    Returns:
+      model   -- the trained SharedClassDQN
+      rewards -- {num_classes: list of total rewards per episode}
+    """
+    model = SharedClassDQN(student_data.shape[1])
+    target_feature_avgs = target_feature_avgs or {}
+    rewards = {n: [] for n in class_counts}
+    for rnd in range(num_rounds):
+        for n in class_counts:
+            targets = target_feature_avgs.get(n)
+            if targets is None:
+                targets = np.tile(student_data.mean(axis=0).round(2), (n, 1))
+            _, r = train_agent(n,
+                               int(np.ceil(len(student_data) / n)),
+                               targets,
+                               student_data,
+                               E,
+                               num_episodes=episodes_per_count,
+                               batch_size=batch_size,
+                               num_envs=num_envs,
+                               verbose=False,
+                               model=model)
+            rewards[n].extend(r)
+            if verbose:
+                print(f"Round {rnd+1}, {n} classes: mean reward = {np.mean(r):.2f}")
+    model.eval()
+    if model_path:
+        torch.save(model.state_dict(), model_path)
+        print(f"\n---------------- Saved shared model to {model_path}")
+    return model, rewards
+
+
 def train_and_allocate(unit_id,num_classes,
                        target_class_size,
                        target_feature_avgs,
@@ -135,78 +235,82 @@ def train_and_allocate(unit_id,num_classes,
                        E,
                        num_episodes=250,
                        batch_size=32,
-                       model_path=None):
+                       model_path=None,
+                       num_envs=8):
     
-    feature_dim = student_data.shape[1]
-    state_dim = num_classes * (feature_dim + 1)
-    action_dim = num_classes
-
+    agent, _ = train_agent(num_classes,
+                           target_class_size,
+                           target_feature_avgs,
+                           student_data,
+                           E,
+                           num_episodes=num_episodes,
+                           batch_size=batch_size,
+                           num_envs=num_envs)
     env = StudentAllocationEnv(num_classes,
                                target_class_size,
                                target_feature_avgs,
                                E)
-    agent = DQNAgent(state_dim, action_dim)
-
-    for ep in range(num_episodes):
-        env.state = env._init_state()
-        total_reward = 0.0
-        idxs = list(range(len(student_data)))
-        random.shuffle(idxs)
-        for idx in idxs:
-            feats = student_data[idx]
-            s = state_to_vector(env.state, feature_dim)
-            a = agent.act(s)
-            r, _ = env.step(feats, a, idx)
-            total_reward += r
-            s_next = state_to_vector(env.state, feature_dim)
-            agent.remember(s, a, r, s_next, False)
-            agent.replay(batch_size)
-        if ep % 10 == 0:
-            if ep == 0:
-                print(f"Episode 00{ep+1}: Total Reward = {total_reward:.2f}, Epsilon = {agent.epsilon:.3f}")
-            elif ep < 100:
-                print(f"Episode 0{ep+1}: Total Reward = {total_reward:.2f}, Epsilon = {agent.epsilon:.3f}")
-            else:
-                print(f"Episode {ep+1}: Total Reward = {total_reward:.2f}, Epsilon = {agent.epsilon:.3f}")
-    print(f"\n---------------- Training completed after {num_episodes} episodes.")
     # Save the trained model for inference
     torch.save(agent.model.state_dict(), model_path)
     print(f"\n---------------- Model saved to {model_path} for later inference.")
     print(f"---------------- Allocating with the saved model: ")
-    allocation_summary = allocate_with_existing_model(student_data, env, agent, unit_id,E)
+    allocation_summary = allocate_with_existing_model(student_data, env, agent, unit_id,E,
+                                                      target_class_size,target_feature_avgs)
     
     return allocation_summary
 
 def returnEnvAndAgent(student_data, num_classes, target_class_size, target_feature_avgs, E,
-                      model_path):
+                      model_path, inference_mode="trace", num_threads=None):
     """
-    Initializes the environment & loads a pretrained agent for inference.
+    Initializes the environment & loads a pretrained agent for inference
+    (see load_inference_agent).
 
     Returns:
       env  -- a reset StudentAllocationEnv
       agent-- a DQNAgent with loaded weights and epsilon=0
     """
-    feature_dim = student_data.shape[1]
-    state_dim = num_classes * (2 + 2*feature_dim)
-    action_dim = num_classes
-
     # 1) Build environment
     env = StudentAllocationEnv(num_classes,
                                target_class_size,
                                target_feature_avgs,
                                E)
     # reset state
-    env.state = env._init_state()
-
-    # 2) Build agent & load weights
-    agent = DQNAgent(state_dim, action_dim)
-    # load saved model
-    checkpoint = torch.load(model_path)
-    agent.model.load_state_dict(checkpoint)
-    agent.model.eval()
+    env.reset()
+
+    # 2) Build agent around the cached model (loaded once per worker)
+    agent = load_inference_agent(student_data.shape[1], num_classes, model_path,
+                                 inference_mode, num_threads)
+    return env, agent
+
+
+def load_inference_agent(feature_dim, num_classes, model_path, inference_mode="trace",
+                         num_threads=None):
+    """
+    Builds a greedy DQNAgent around a registry-cached checkpoint.
+    The weights come from the model registry, so each checkpoint is only
+    deserialized once per worker.
+    The agent acts through a compiled InferencePolicy (see
+    DQNAgent.enable_inference); inference_mode=None keeps the eager model.
+    A SharedClassDQN checkpoint serves any `num_classes`.
+    `num_threads` pins torch threads when given; servers set
+    INFERENCE_THREADS once at startup instead.
+    """
+    state_dim = num_classes * (2 + 2*feature_dim)
+    action_dim = num_classes
+
+    model = get_dqn(model_path)
+    if isinstance(model, SharedClassDQN):
+        if model.feature_dim != feature_dim:
+            raise ValueError(f"{model_path} does not match {feature_dim} features")
+    elif model.fc1.in_features != state_dim or model.fc3.out_features != action_dim:
+        raise ValueError(f"{model_path} does not match {num_classes} classes")
+    agent = DQNAgent(state_dim, action_dim, model=model, memory_size=0)
     # deterministic policy
     agent.epsilon = 0.0
-    return env, agent
+    if inference_mode:
+        agent.enable_inference(inference_mode, num_threads,
+                               compiled=get_dqn_inference(model_path, inference_mode))
+    return agent
 
 
 def printSummary(env, target_feature_avgs):
@@ -216,9 +320,9 @@ def printSummary(env, target_feature_avgs):
     feature_dim = target_feature_avgs.shape[1]
     print("\n------------ Final Class Summary:")
     for i, tgt in enumerate(target_feature_avgs):
-        cnt = env.state[i]['count']
+        cnt = env.counts[i]
         if cnt > 0:
-            avg = env.state[i]['sum_features'] / cnt
+            avg = env.sum_features[i] / cnt
         else:
             avg = np.zeros(feature_dim)
         # round for readability
@@ -231,34 +335,136 @@ def printSummary(env, target_feature_avgs):
         )
 
 
-def allocate_with_existing_model(student_data, env, agent, unit_id,E,target_class_size,target_feature_avgs):
+def greedy_pass(student_data, env, agent, order, stop_at=None):
     """
-    Runs a single allocation pass with a loaded agent.
+    Resets `env` and places the students in `order` with the agent's
+    greedy actions, never choosing a class that is already full.
+    With `stop_at` (a time.time() timestamp) the pass is abandoned once
+    that time has passed.
 
     Returns:
-      allocations: list of class assignments per student index
+      total reward collected over the pass, or None if it was abandoned
     """
-    feature_dim = student_data.shape[1]
-    # reset environment state
-    env.state = env._init_state()
+    env.reset()
+    total = 0.0
+    for n, idx in enumerate(order):
+        if stop_at is not None and n % 32 == 0 and time.time() > stop_at:
+            return None
+        s = env.get_state(copy=False)
+        a = agent.act(s, env.action_mask())
+        r, _ = env.step(student_data[idx], a, idx)
+        total += r
+    return total
+
 
+def allocate_with_existing_model(student_data, env, agent, unit_id,E,target_class_size,target_feature_avgs,
+                                 refine_ms=0):
+    """
+    Runs a single allocation pass with a loaded agent, optionally followed
+    by `refine_ms` milliseconds of local-search refinement.
+
+    Returns:
+      allocations: list of class assignments per student index
+    """
     print(f"\n---------------- Allocating with the saved model: ")
-    allocations = []
     idxs = list(range(len(student_data)))
     random.shuffle(idxs)
-    for idx in idxs:
-        feats = student_data[idx]
-        s = state_to_vector(env.state,
-                    feature_dim,
-                    target_class_size,
-                    target_feature_avgs)
-        a = agent.act(s)
-        allocations.append(a)
-        env.step(feats, a, idx)
+    greedy_pass(student_data, env, agent, idxs)
+
+    if refine_ms:
+        refine_allocation(env, student_data, time_budget_ms=refine_ms)
 
     allocation_summary = build_allocation_summary(env, env.target_feature_avgs, unit_id,E)
     # print summaries
     printSummary(env, env.target_feature_avgs)
     print_link_summary(env, env.E)
 
-    return allocation_summary
\ No newline at end of file
+    return allocation_summary
+
+
+def allocate_with_beam_search(student_data, env, agent, unit_id, E,
+                              target_class_size, target_feature_avgs,
+                              beam_width=8, refine_ms=0):
+    """
+    Beam-search allocation driven by the agent's Q-values.
+
+    All beams visit the students in one shared random order. At each step
+    the candidates (beam, class) of every beam are scored in a single
+    batched forward pass as the beam's accumulated env reward + Q(s, a),
+    i.e. reward so far plus the agent's estimate of the rest, full classes
+    excluded, and the top `beam_width` survive. The surviving beam with
+    the highest total env reward is written into `env`, so save_allocations works as after a greedy pass,
+    and is optionally refined by local search for `refine_ms` milliseconds.
+
+    Returns:
+      allocation_summary as for allocate_with_existing_model
+    """
+    num_students = student_data.shape[0]
+    num_classes = env.num_classes
+    beams = VecAllocationEnv(beam_width, num_classes, target_class_size,
+                             target_feature_avgs, E, student_data)
+    order = np.random.permutation(num_students)
+    s = beams.reset(np.tile(order, (beam_width, 1)))
+
+    # all beams start identical: only the first one may expand at step 0
+    alive = np.zeros(beam_width, dtype=bool)
+    alive[0] = True
+    beam_rewards = np.zeros(beam_width)
+
+    print(f"\n---------------- Allocating with beam search (width {beam_width}): ")
+    done = False
+    while not done:
+        q = np.where(beams.action_masks() & alive[:, None], agent.q_values(s), -np.inf)
+        cand = beam_rewards[:, None] + q                         # (B, C)
+        flat = np.argsort(cand, axis=None)[::-1][:beam_width]
+        parents, actions = np.divmod(flat, num_classes)
+        beams.select(parents)
+        r, done = beams.step(actions)
+        alive = np.isfinite(cand.reshape(-1)[flat])
+        beam_rewards = beam_rewards[parents] + r
+        s = beams.get_state()
+
+    best = int(np.argmax(np.where(alive, beam_rewards, -np.inf)))
+    env.load_assignment(beams.assignment[best], student_data, order)
+    if refine_ms:
+        refine_allocation(env, student_data, time_budget_ms=refine_ms)
+
+    allocation_summary = build_allocation_summary(env, env.target_feature_avgs, unit_id,E)
+    printSummary(env, env.target_feature_avgs)
+    print_link_summary(env, env.E)
+
+    return allocation_summary
+
+
+def allocate_with_milp(student_data, env, agent, unit_id, E, target_class_size, target_feature_avgs,
+                       time_limit=10.0, refine_ms=0):
+    """
+    Allocates the unit exactly with the MILP solver for `time_limit`
+    seconds of wall-clock time, warm-started with a greedy agent pass in
+    a fixed student order (optionally refined by local search for
+    `refine_ms` milliseconds). The warm start is returned when the solver
+    finds nothing better, so the result is never worse than it; the
+    solver info carries the MIP dual bound and the gap of the result.
+    Without refinement the warm start, and with it the whole run, is
+    deterministic.
+
+    Returns:
+      (allocation_summary, solver_info)
+    """
+    print(f"\n---------------- Allocating with MILP solver (limit {time_limit}s): ")
+    order = np.random.default_rng(0).permutation(len(student_data))
+    greedy_pass(student_data, env, agent, order)
+    if refine_ms:
+        refine_allocation(env, student_data, time_budget_ms=refine_ms, seed=0)
+
+    labels, info = solve_allocation_milp(student_data, env.num_classes, target_class_size,
+                                         target_feature_avgs, E, time_limit=time_limit,
+                                         initial_labels=env.assignment)
+    print(f"---------------- Solver: {info}")
+    env.load_assignment(labels, student_data)
+
+    allocation_summary = build_allocation_summary(env, env.target_feature_avgs, unit_id,E)
+    printSummary(env, env.target_feature_avgs)
+    print_link_summary(env, env.E)
+
+    return allocation_summary, info
@@ -0,0 +1,106 @@
+# what_if.py
+import numpy as np
+
+from model.dqn.allocation_env import LINK_REWARDS, NO_LINK_PENALTY, OVERFILL_PENALTY, NUM_LINK_TYPES
+from model.dqn.allocation_env import in_links
+
+
+def score_class_moves(env, student_data, student_idx):
+    """
+    Scores moving one allocated student into every class of `env` at once.
+
+    Works on the env's membership arrays: class sizes and feature sums come
+    from counts/sum_features, link rewards from the student to each class
+    from compute_link_rewards and links from each class to the student from
+    one in_links lookup. The objective delta matches LocalSearchState.move_deltas.
+
+    Args:
+      env: StudentAllocationEnv holding the current allocation
+      student_data: (N x D) feature matrix
+      student_idx: index of the student to move
+
+    Returns:
+      dict of arrays indexed by class (the current class scores a no-op):
+        current_class        class the student is in now
+        new_count            (C,)     class size with the student in it
+        current_averages     (C, D)
+        new_averages         (C, D)   class averages with the student in it
+        current_deviation    (C,)     ||avg - tgt|| / ||tgt||
+        new_deviation        (C,)
+        link_gains           (C, 6)   links per relation gained with the class
+        link_losses          (6,)     links per relation left behind in the current class
+        source_new_averages  (D,)     current class averages without the student
+        source_new_deviation          current class deviation without the student
+        score_delta          (C,)     objective change of the move
+        ranking              (C,)     class indices, best move first
+    """
+    s = int(student_idx)
+    a = int(env.assignment[s])
+    if a < 0:
+        raise ValueError(f"Student index {s} is not allocated")
+    x = np.asarray(student_data[s], dtype=np.float64)
+    C = env.num_classes
+    T = env.target_class_size
+    tgt = np.asarray(env.target_feature_avgs, dtype=np.float64)
+    norms = np.linalg.norm(tgt, axis=1) + 1e-6
+
+    # class arrays with the student taken out of its current class
+    counts = env.counts.astype(np.int64)
+    sums = env.sum_features.astype(np.float64)
+    base_counts = counts.copy()
+    base_counts[a] -= 1
+    base_sums = sums.copy()
+    base_sums[a] -= x
+
+    current_avgs = sums / np.maximum(counts, 1)[:, None]
+    new_counts = base_counts + 1
+    new_avgs = (base_sums + x) / new_counts[:, None]
+    source_avgs = base_sums[a] / max(base_counts[a], 1)
+
+    deviation = lambda avg, idx=slice(None): np.linalg.norm(avg - tgt[idx], axis=-1) / norms[idx]
+    current_dev = deviation(current_avgs)
+    new_dev = deviation(new_avgs)
+    source_dev = float(deviation(source_avgs, a))
+
+    # links in both directions between the student and each class, per relation
+    out_rel = env.link_counts[s].astype(np.int64)
+    src, lbl = in_links(env.E, s)
+    src_cls = env.assignment[src]
+    keep = (src_cls >= 0) & (src != s)
+    in_rel = np.zeros_like(out_rel)
+    np.add.at(in_rel, (src_cls[keep], lbl[keep]), 1)
+    links = out_rel + in_rel
+    # link reward with each class's other members, averaged over both
+    # directions; the student itself never counts towards its class
+    out_reward = env.compute_link_rewards(s)
+    in_reward = in_rel @ LINK_REWARDS + NO_LINK_PENALTY * (counts - in_rel.sum(axis=1))
+    self_lbl = int(env.E[s, s])
+    if 0 <= self_lbl < NUM_LINK_TYPES:
+        links[a, self_lbl] -= 1
+        out_reward[a] -= LINK_REWARDS[self_lbl]
+    else:
+        out_reward[a] -= NO_LINK_PENALTY
+    in_reward[a] -= NO_LINK_PENALTY
+    link_reward = 0.5 * (out_reward + in_reward)
+    losses = links[a].copy()
+
+    size = lambda n: np.abs(n - T) / T + OVERFILL_PENALTY * np.maximum(n - T, 0)
+    score = (-(size(new_counts) - size(base_counts) + size(base_counts[a]) - size(counts[a]))
+             - 2 * (new_dev - current_dev + source_dev - current_dev[a])
+             + link_reward - link_reward[a])
+    score[a] = 0.0
+
+    return {
+        'current_class':        a,
+        'new_count':            np.where(np.arange(C) == a, counts, new_counts),
+        'current_averages':     current_avgs,
+        'new_averages':         np.where((np.arange(C) == a)[:, None], current_avgs, new_avgs),
+        'current_deviation':    current_dev,
+        'new_deviation':        np.where(np.arange(C) == a, current_dev, new_dev),
+        'link_gains':           np.where((np.arange(C) == a)[:, None], 0, links),
+        'link_losses':          losses,
+        'source_new_averages':  source_avgs,
+        'source_new_deviation': source_dev,
+        'score_delta':          score,
+        'ranking':              np.argsort(-score, kind='stable'),
+    }
@@ -0,0 +1,283 @@
+# milp_allocator.py
+import math
+import multiprocessing as mp
+import multiprocessing.forkserver
+import time
+
+import numpy as np
+from scipy.optimize import milp, LinearConstraint, Bounds
+from scipy.sparse import coo_matrix, vstack
+
+from model.dqn.allocation_env import LINK_REWARDS, NO_LINK_PENALTY, link_edges
+
+# largest unit the exact solver handles: up to here HiGHS proves or nearly proves
+# optimality within a few seconds, beyond it the gap stays wide
+MILP_MAX_STUDENTS = 40
+# HiGHS gets this share of the remaining time so it can return its incumbent before the kill
+SOLVER_TIME_SHARE = 0.8
+
+
+def _pair_gains(E, num_students):
+    """
+    Collapses directed links into unordered pairs (i < j) with the mean of
+    both directions' link rewards, measured relative to "no link".
+    """
+    src, dst, lbl = link_edges(E)
+    keep = src != dst
+    src, dst, lbl = src[keep], dst[keep], lbl[keep]
+    gain = 0.5 * (LINK_REWARDS[lbl] - NO_LINK_PENALTY)
+    lo, hi = np.minimum(src, dst), np.maximum(src, dst)
+    keys, inv = np.unique(lo * num_students + hi, return_inverse=True)
+    gains = np.bincount(inv, weights=gain)
+    return keys // num_students, keys % num_students, gains
+
+
+def _build_problem(X, tgt, size_lo, size_hi, target_class_size, pi, pj, gains, cutoff=None):
+    """
+    Builds the MILP of placing the students X into len(tgt) classes.
+
+    x[i, c] = 1 puts student i in class c. Class c holds between size_lo[c]
+    and size_hi[c] students. Per class and feature, the absolute deviation
+    of the summed features from target * class size is penalised (an L1
+    stand-in for the env's feature term). Same-class pairs earn their link
+    gain: positive pairs through z <= x_i, z <= x_j, and negative pairs pay
+    through y >= x_i + x_j - 1. Pair indices are rows of X.
+
+    With `cutoff`
+    the objective is constrained to at most that value, e.g. the objective
+    of a known allocation, so worse branches are pruned early.
+
+    Returns:
+      dict of milp() arguments plus 'x_slice' locating the (N x C) x block
+    """
+    N, D = X.shape
+    C = len(tgt)
+
+    pos = gains > 0
+    neg = gains < 0
+    pos_i, pos_j, pos_g = pi[pos], pj[pos], gains[pos]
+    neg_i, neg_j, neg_g = pi[neg], pj[neg], -gains[neg]
+    P, Q = len(pos_g), len(neg_g)
+
+    # variable layout: x (N*C) | u (C*D) | z (P*C) | y (Q)
+    nx, nu, nz = N * C, C * D, P * C
+    ox, ou, oz, oy = 0, nx, nx + nu, nx + nu + nz
+    nvar = oy + Q
+    xid = lambda i, c: ox + i * C + c
+
+    c_vec = np.zeros(nvar)
+    norms = np.linalg.norm(tgt, axis=1) + 1e-6
+    c_vec[ou:oz] = (2.0 / (target_class_size * norms)).repeat(D)
+    c_vec[oz:oy] = -np.repeat(pos_g, C)
+    c_vec[oy:] = neg_g
+
+    rows, lb, ub = [], [], []
+
+    def add(r, c, v, nrows, lo, hi):
+        rows.append(coo_matrix((v, (r, c)), shape=(nrows, nvar)))
+        lb.append(np.broadcast_to(lo, nrows))
+        ub.append(np.broadcast_to(hi, nrows))
+
+    ii, cc = np.meshgrid(np.arange(N), np.arange(C), indexing='ij')
+    ii, cc = ii.ravel(), cc.ravel()
+
+    # every student in exactly one class
+    add(ii, xid(ii, cc), np.ones(nx), N, 1, 1)
+    # class sizes
+    add(cc, xid(ii, cc), np.ones(nx), C, size_lo, size_hi)
+
+    # feature deviation: ±Σ_i x_ic (f_id - tgt_cd) - u_cd <= 0
+    ri = np.repeat(np.arange(N * C), D)
+    ci = np.repeat(cc, D)
+    di = np.tile(np.arange(D), N * C)
+    row = ci * D + di
+    coef = X[np.repeat(ii, D), di] - tgt[ci, di]
+    u_rows = np.arange(C * D)
+    for sign in (1.0, -1.0):
+        add(np.concatenate([row, u_rows]),
+            np.concatenate([ox + ri, ou + u_rows]),
+            np.concatenate([sign * coef, -np.ones(C * D)]),
+            C * D, -np.inf, 0)
+
+    # positive pairs: z_pc <= x_ic and z_pc <= x_jc
+    if P:
+        p_idx = np.repeat(np.arange(P), C)
+        c_idx = np.tile(np.arange(C), P)
+        z_col = oz + p_idx * C + c_idx
+        r = np.arange(P * C)
+        for end in (pos_i, pos_j):
+            add(np.concatenate([r, r]),
+                np.concatenate([z_col, xid(end[p_idx], c_idx)]),
+                np.concatenate([np.ones(P * C), -np.ones(P * C)]),
+                P * C, -np.inf, 0)
+
+    # negative pairs: x_ic + x_jc - y_q <= 1
+    if Q:
+        q_idx = np.repeat(np.arange(Q), C)
+        c_idx = np.tile(np.arange(C), Q)
+        r = np.arange(Q * C)
+        add(np.concatenate([r, r, r]),
+            np.concatenate([xid(neg_i[q_idx], c_idx), xid(neg_j[q_idx], c_idx), oy + q_idx]),
+            np.concatenate([np.ones(Q * C), np.ones(Q * C), -np.ones(Q * C)]),
+            Q * C, -np.inf, 1)
+
+    if cutoff is not None:
+        nz_cols = np.flatnonzero(c_vec)
+        add(np.zeros(len(nz_cols), dtype=np.int64), nz_cols, c_vec[nz_cols], 1, -np.inf, cutoff)
+
+    integrality = np.zeros(nvar)
+    integrality[ox:ou] = 1
+    upper = np.full(nvar, np.inf)
+    upper[ox:ou] = 1
+    upper[oz:] = 1
+    return {
+        'c':           c_vec,
+        'integrality': integrality,
+        'bounds':      Bounds(np.zeros(nvar), upper),
+        'constraints': LinearConstraint(vstack(rows).tocsr(), np.concatenate(lb), np.concatenate(ub)),
+        'x_slice':     (ox, ou),
+    }
+
+
+def _milp_objective(labels, X, tgt, target_class_size, pi, pj, gains):
+    """Objective value of _build_problem for a given (N,) class labelling."""
+    C, D = tgt.shape
+    norms = np.linalg.norm(tgt, axis=1) + 1e-6
+    dev = np.zeros((C, D))
+    np.add.at(dev, labels, X)
+    dev = np.abs(dev - np.bincount(labels, minlength=C)[:, None] * tgt)
+    same = labels[pi] == labels[pj]
+    return float((2.0 / (target_class_size * norms)) @ dev.sum(axis=1) - gains[same].sum())
+
+
+def _solve_child(conn, problem, time_limit):
+    """Runs HiGHS in the solver process and sends back a plain dict."""
+    res = milp(problem['c'], integrality=problem['integrality'], bounds=problem['bounds'],
+               constraints=problem['constraints'], options={'time_limit': time_limit, 'disp': False})
+    conn.send({
+        'status':  int(res.status),
+        'message': res.message,
+        'x':       res.x,
+        'fun':     None if res.x is None else float(res.fun),
+        'bound':   None if res.get('mip_dual_bound') is None else float(res.mip_dual_bound),
+        'gap':     None if res.get('mip_gap') is None else float(res.mip_gap),
+    })
+    conn.close()
+
+
+def _solver_context():
+    """
+    Multiprocessing context for solver processes. A forkserver, started
+    once with this module preloaded, forks every solver from a
+    single-threaded process, so nothing is forked from the threaded web
+    server and each solve starts in milliseconds. Platforms without
+    forkserver spawn instead.
+    """
+    if 'forkserver' not in mp.get_all_start_methods():
+        return mp.get_context('spawn')
+    ctx = mp.get_context('forkserver')
+    ctx.set_forkserver_preload(['__main__', __name__])
+    return ctx
+
+
+def start_solver_server():
+    """
+    Starts the forkserver at service start-up so the first MILP request
+    does not pay for it inside its time limit.
+    """
+    if _solver_context().get_start_method() == 'forkserver':
+        mp.forkserver.ensure_running()
+        print("\n------------ MILP solver server started")
+
+
+def _solve_with_deadline(problem, seconds):
+    """
+    Solves `problem` in a child process that is killed after `seconds` of
+    wall-clock time, since HiGHS can overrun its own time_limit by far
+    (presolve and the root LP are not interrupted).
+
+    Returns:
+      dict with status, message, solution x (None without incumbent),
+      objective, dual bound and gap
+    """
+    deadline = time.perf_counter() + seconds
+    ctx = _solver_context()
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_solve_child, args=(send, problem, max(0.05, seconds * SOLVER_TIME_SHARE)),
+                       daemon=True)
+    proc.start()
+    send.close()
+    try:
+        result = recv.recv() if recv.poll(max(0.0, deadline - time.perf_counter())) else None
+    except EOFError:
+        result = None
+    finally:
+        if proc.is_alive():
+            proc.kill()
+        proc.join()
+        recv.close()
+    if result is None:
+        return {'status': -1, 'message': 'Killed at the wall-clock deadline',
+                'x': None, 'fun': None, 'bound': None, 'gap': None}
+    return result
+
+
+def solve_allocation_milp(student_data, num_classes, target_class_size,
+                          target_feature_avgs, E, time_limit=10.0, initial_labels=None):
+    """
+    Solves the whole unit as one MILP (_build_problem) with HiGHS
+    (scipy.optimize.milp), class sizes between floor(N / C) and
+    target_class_size, within `time_limit` seconds of wall-clock time.
+    The solve runs in a child process that is killed at the deadline.
+
+    `initial_labels` (e.g. a deterministic DQN pass) act as the warm
+    start: their objective is the cutoff of the search, and they are
+    returned when the solver finds nothing better in time. The reported
+    dual bound and gap always refer to the returned allocation; a gap of
+    0 means it is optimal for the MILP objective.
+
+    Returns:
+      labels -- (N,) class per student, or None without warm start when
+                the solver found no feasible solution in time
+      info   -- dict with solver status and message, 'source' ('milp' or
+                'warm_start'), MILP objective, dual bound, relative gap
+                and runtime
+    """
+    X = np.asarray(student_data, dtype=np.float64)
+    tgt = np.asarray(target_feature_avgs, dtype=np.float64)
+    N = len(X)
+    C = num_classes
+    size_floor = math.floor(N / C)
+    pi, pj, gains = _pair_gains(E, N)
+    start = time.perf_counter()
+
+    warm = None
+    if initial_labels is not None:
+        initial_labels = np.asarray(initial_labels, dtype=np.int64)
+        warm = _milp_objective(initial_labels, X, tgt, target_class_size, pi, pj, gains)
+    problem = _build_problem(X, tgt, np.full(C, size_floor), np.full(C, target_class_size),
+                             target_class_size, pi, pj, gains,
+                             cutoff=None if warm is None else warm + 1e-6 * max(1.0, abs(warm)))
+    res = _solve_with_deadline(problem, time_limit)
+
+    labels, objective, source = None, None, 'milp'
+    if res['x'] is not None:
+        ox, ou = problem['x_slice']
+        labels = res['x'][ox:ou].reshape(N, C).argmax(axis=1)
+        objective = _milp_objective(labels, X, tgt, target_class_size, pi, pj, gains)
+    if warm is not None and (labels is None or objective > warm):
+        labels, objective, source = initial_labels.copy(), warm, 'warm_start'
+    bound = res['bound']
+    gap = None
+    if objective is not None and bound is not None:
+        gap = max(0.0, objective - bound) / max(abs(objective), 1e-9)
+    info = {
+        'status':    res['status'],
+        'message':   res['message'],
+        'source':    source,
+        'objective': None if objective is None else round(objective, 4),
+        'bound':     None if bound is None else round(bound, 4),
+        'gap':       None if gap is None else round(gap, 6),
+        'seconds':   round(time.perf_counter() - start, 3),
+    }
+    return labels, info
@@ -0,0 +1,122 @@
+# registry.py
+import os
+import threading
+import time
+
+import torch
+
+from model.dqn.dqn_agent import DQN, SharedClassDQN, compile_for_inference, example_state_dim
+from model.rgcn.rgcn_linkpred import InductiveRGCN, LinkPredictor
+
+# class-count-agnostic policy serving every class count, trained on the data/ CSVs with
+#   python -m model.dqn.train_parallel --csv --shared --classes 3 4 5 6 7 8 9 10 11 12 --episodes 300
+SHARED_DQN_CHECKPOINT = "model/dqn/shared.pth"
+RGCN_CHECKPOINT  = "model/rgcn/rgcn_linkpred_checkpoint.pth"
+
+
+class ModelRegistry:
+    def __init__(self, max_idle=1800):
+        """
+        Per-process cache of loaded checkpoints.
+
+        Entries are keyed by (path, kind). An entry is reloaded when the
+        checkpoint's mtime changes and evicted once it has not been used
+        for `max_idle` seconds. Cached modules are shared between requests,
+        so callers must treat them as read-only.
+        """
+        self.max_idle = max_idle
+        self._entries = {}
+        # re-entrant: a loader may fetch another cached entry
+        self._lock = threading.RLock()
+
+    def get(self, path, kind, loader):
+        """Returns loader(path), loading it only on first use or after the file changed."""
+        key = (path, kind)
+        mtime = os.path.getmtime(path)
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._entries.get(key)
+            if entry is None or entry['mtime'] != mtime:
+                print(f"\n------------ Loading {kind} from {path}")
+                entry = {'mtime': mtime, 'value': loader(path)}
+                self._entries[key] = entry
+            entry['last_used'] = now
+            return entry['value']
+
+    def _evict_idle(self, now):
+        idle = [k for k, e in self._entries.items() if now - e['last_used'] > self.max_idle]
+        for key in idle:
+            del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+registry = ModelRegistry()
+
+
+def load_dqn(path):
+    """
+    Builds an eval-mode DQN, or a SharedClassDQN for class-count-agnostic
+    checkpoints, from a state dict, inferring its dimensions.
+    """
+    state = torch.load(path, map_location='cpu')
+    if 'class_fc1.weight' in state:
+        hidden_dim, in_dim = state['class_fc1.weight'].shape
+        model = SharedClassDQN((in_dim // 2 - 1) // 3, hidden_dim)
+    else:
+        model = DQN(state['fc1.weight'].shape[1], state['fc3.weight'].shape[0])
+    model.load_state_dict(state)
+    model.eval()
+    return model
+
+
+def load_rgcn(path):
+    """Builds the eval-mode (InductiveRGCN, LinkPredictor) pair from a checkpoint."""
+    ckpt = torch.load(path, map_location='cpu')
+    in_channels      = ckpt['in_channels']
+    hidden_channels  = ckpt['hidden_channels']
+    out_channels     = ckpt['out_channels']
+    num_relations    = ckpt['num_relations']
+    link_hidden_dim  = ckpt['link_hidden_dim']
+
+    model = InductiveRGCN(in_channels, hidden_channels, out_channels, num_relations)
+    link_predictor = LinkPredictor(out_channels, link_hidden_dim, num_relations)
+
+    model.load_state_dict(     ckpt['rgcn_state'])
+    link_predictor.load_state_dict(ckpt['linkpred_state'])
+
+    model.eval()
+    link_predictor.eval()
+    return model, link_predictor
+
+
+def get_dqn(path):
+    return registry.get(path, 'dqn', load_dqn)
+
+
+def get_dqn_inference(path, mode="trace"):
+    """Cached compile_for_inference copy of a DQN checkpoint."""
+    def loader(p):
+        model = get_dqn(p)
+        return compile_for_inference(model, example_state_dim(model), mode)
+    return registry.get(path, f'dqn-{mode}', loader)
+
+
+def get_rgcn(path=RGCN_CHECKPOINT):
+    return registry.get(path, 'rgcn', load_rgcn)
+
+
+def warm_up_models(dqn_paths=(SHARED_DQN_CHECKPOINT,), rgcn_path=RGCN_CHECKPOINT, mode="trace"):
+    """Loads the default checkpoints into the registry, skipping missing files."""
+    for path in dqn_paths:
+        if os.path.exists(path):
+            get_dqn_inference(path, mode)
+        else:
+            print(f"\n------------ Skipping missing checkpoint {path}")
+    if os.path.exists(rgcn_path):
+        get_rgcn(rgcn_path)
+    else:
+        print(f"\n------------ Skipping missing checkpoint {rgcn_path}")
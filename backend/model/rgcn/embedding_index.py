@@ -0,0 +1,175 @@
+# embedding_index.py
+import math
+import threading
+import time
+
+import numpy as np
+import torch
+from scipy.cluster.vq import kmeans2
+
+from database.models import CalculatedScores
+from model.registry import get_rgcn, RGCN_CHECKPOINT
+from model.rgcn.embedding_store import get_student_embeddings
+from model.rgcn.link_table import pair_projections, BLOCK_PAIRS
+from model.rgcn.predict_link import LINK_MAP, NO_LINK
+from model.unit_cache import FEATURE_COLUMNS
+
+# up to this many students a query scores every target exactly
+EXACT_MAX_STUDENTS = 2000
+# inverted lists probed per relation on larger cohorts
+NPROBE = 8
+# sampled training points per inverted list
+IVF_TRAIN_PER_LIST = 40
+
+
+class EmbeddingIndex:
+    def __init__(self, student_ids, emb, link_predictor, exact_max=EXACT_MAX_STUDENTS, seed=0):
+        """
+        Nearest-candidate index over student embeddings for the LinkPredictor head.
+
+        The head's first layer is split into source (U) and target (V)
+        projections (pair_projections), so scoring a source against a target
+        costs one add, a relu and fc2. Cohorts up to `exact_max` students are
+        scored exactly in blocks. Larger ones get an IVF index: V is
+        clustered into ~sqrt(N) inverted lists, a query scores the centroids
+        with the head, probes the NPROBE best lists per relation and
+        reranks only their members.
+        """
+        self.student_ids = np.asarray(student_ids, dtype=np.int64)
+        self.row_of = {int(s): i for i, s in enumerate(self.student_ids)}
+        self.link_predictor = link_predictor
+        with torch.no_grad():
+            self.U, self.V, self.fc2 = pair_projections(link_predictor, emb)
+
+        self.centroids = None
+        N = len(self.student_ids)
+        if N > exact_max:
+            nlist = int(math.sqrt(N))
+            # train the lists on a sample, as IVF indexes usually do, then assign everyone
+            rng = np.random.default_rng(seed)
+            sample = rng.choice(N, min(N, IVF_TRAIN_PER_LIST * nlist), replace=False)
+            centroids, _ = kmeans2(self.V.numpy()[sample].astype(np.float64), nlist, minit='++', seed=seed)
+            self.centroids = torch.from_numpy(centroids.astype(np.float32))
+            labels = torch.cat([torch.cdist(self.V[start:start + 8192], self.centroids).argmin(dim=1)
+                                for start in range(0, N, 8192)]).numpy()
+            self.list_order = np.argsort(labels, kind='stable')
+            self.list_bounds = np.searchsorted(labels[self.list_order], np.arange(nlist + 1))
+            print(f"\n------------ Built IVF index: {N} students in {nlist} lists")
+
+    def update_rows(self, student_ids, emb):
+        """Replaces the embeddings of students already in the index (IVF lists are kept)."""
+        rows = torch.as_tensor([self.row_of[int(s)] for s in student_ids], dtype=torch.long)
+        with torch.no_grad():
+            U, V, _ = pair_projections(self.link_predictor, emb)
+        self.U[rows] = U
+        self.V[rows] = V
+
+    def _probs(self, u, V):
+        """Relation probabilities of one source projection against rows of V, in blocks."""
+        out = []
+        for start in range(0, len(V), BLOCK_PAIRS):
+            hidden = torch.relu(u + V[start:start + BLOCK_PAIRS])
+            out.append(torch.softmax(self.fc2(hidden), dim=-1))
+        return torch.cat(out) if out else torch.zeros((0, len(LINK_MAP)))
+
+    def _candidates(self, u, relations, nprobe):
+        if self.centroids is None:
+            return np.arange(len(self.student_ids))
+        centroid_probs = self._probs(u, self.centroids)
+        lists = set()
+        for r in relations:
+            lists.update(centroid_probs[:, r].topk(min(nprobe, len(self.centroids))).indices.tolist())
+        return np.concatenate([self.list_order[self.list_bounds[c]:self.list_bounds[c + 1]]
+                               for c in sorted(lists)])
+
+    def query(self, student_id, relations=None, k=10, exclude=(), min_probability=0.0, nprobe=NPROBE):
+        """
+        Most likely targets of `student_id` for each relation.
+
+        Args:
+          student_id: real student ID of the source
+          relations: relation indices (see LINK_MAP), every relation but no_link by default
+          k: suggestions per relation
+          exclude: student IDs never suggested (the source itself always is)
+          min_probability: drop suggestions below this relation probability
+
+        Returns:
+          {link_type: [(target student ID, probability), ...]} best first
+        """
+        relations = [r for r in LINK_MAP if r != NO_LINK] if relations is None else list(relations)
+        i = self.row_of[int(student_id)]
+        with torch.no_grad():
+            cand = self._candidates(self.U[i], relations, nprobe)
+            drop = np.isin(self.student_ids[cand], list(exclude)) | (cand == i)
+            cand = cand[~drop]
+            probs = self._probs(self.U[i], self.V[torch.as_tensor(cand, dtype=torch.long)])
+
+        results = {}
+        for r in relations:
+            top_p, top_j = probs[:, r].topk(min(k, len(cand)))
+            results[LINK_MAP[r]] = [(int(self.student_ids[cand[j]]), float(p))
+                                    for p, j in zip(top_p.tolist(), top_j.tolist()) if p >= min_probability]
+        return results
+
+
+class SchoolIndex:
+    def __init__(self, path=RGCN_CHECKPOINT, max_age=600):
+        """
+        Lazily built EmbeddingIndex over every student with calculated
+        scores. Students whose scores are saved are patched in on the next
+        query; a student the index has not seen triggers a rebuild, as does
+        an index older than `max_age` seconds (other worker processes may
+        have saved scores).
+        """
+        self.path = path
+        self.max_age = max_age
+        self.index = None
+        self.built_at = 0.0
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def mark_dirty(self, student_id):
+        with self._lock:
+            self._dirty.add(int(student_id))
+
+    def invalidate(self):
+        with self._lock:
+            self.index = None
+
+    def get(self, db):
+        with self._lock:
+            if self.index is not None and self._dirty:
+                dirty, self._dirty = self._dirty, set()
+                if any(s not in self.index.row_of for s in dirty):
+                    self.index = None
+                else:
+                    ids, X = self._load_scores(db, dirty)
+                    if ids:
+                        self.index.update_rows(ids, torch.from_numpy(get_student_embeddings(ids, X, self.path)))
+            if self.index is not None and time.monotonic() - self.built_at > self.max_age:
+                self.index = None
+            if self.index is None:
+                start = time.perf_counter()
+                self._dirty.clear()
+                ids, X = self._load_scores(db)
+                _, link_predictor = get_rgcn(self.path)
+                emb = torch.from_numpy(get_student_embeddings(ids, X, self.path))
+                self.index = EmbeddingIndex(ids, emb, link_predictor)
+                self.built_at = time.monotonic()
+                print(f"\n------------ Indexed {len(ids)} student embeddings in "
+                      f"{time.perf_counter() - start:.2f}s")
+            return self.index
+
+    @staticmethod
+    def _load_scores(db, student_ids=None):
+        columns = [getattr(CalculatedScores, c) for c in FEATURE_COLUMNS]
+        query = db.query(CalculatedScores.student_id, *columns).order_by(CalculatedScores.student_id)
+        if student_ids is not None:
+            query = query.filter(CalculatedScores.student_id.in_(list(student_ids)))
+        rows = query.all()
+        ids = [row[0] for row in rows]
+        X = np.array([row[1:] for row in rows], dtype=np.float32).reshape(len(rows), len(columns))
+        return ids, X
+
+
+school_index = SchoolIndex()
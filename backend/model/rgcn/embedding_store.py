@@ -0,0 +1,156 @@
+# embedding_store.py
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import torch
+
+from model.registry import get_rgcn, RGCN_CHECKPOINT
+
+EMBEDDING_DIR = "model/rgcn/cache/embeddings"
+
+
+def feature_hash(row):
+    """64-bit hash of a feature row as float32, so equal scores map to equal keys."""
+    digest = hashlib.blake2b(np.ascontiguousarray(row, dtype=np.float32).tobytes(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class EmbeddingStore:
+    def __init__(self, directory=EMBEDDING_DIR, initial_capacity=1024):
+        """
+        Cache of InductiveRGCN (MLP branch) embeddings keyed by student ID
+        and a hash of the student's feature row.
+
+        Rows live in a memory-mapped float32 array on disk next to an index
+        of (student_id, feature hash, slot), so the cache survives restarts.
+        The whole store is dropped when the checkpoint it was built with
+        changes. The on-disk copy assumes a single writing process.
+        """
+        self.directory = directory
+        self.initial_capacity = initial_capacity
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._entries = {}      # student_id -> (feature hash, slot)
+        self._free = []
+        self._size = 0          # slots ever handed out
+        self._emb = None
+        self.dim = None
+        self.model_key = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with open(self._path("meta.json")) as f:
+                meta = json.load(f)
+            index = np.load(self._path("index.npz"))
+            self._emb = np.memmap(self._path("embeddings.f32"), dtype=np.float32, mode='r+',
+                                  shape=(meta['capacity'], meta['dim']))
+        except (OSError, ValueError, KeyError):
+            return
+        self.dim, self.model_key, self._size = meta['dim'], meta['model_key'], meta['size']
+        self._entries = {int(s): (int(h), int(i))
+                         for s, h, i in zip(index['ids'], index['hashes'], index['slots'])}
+        self._free = index['free'].tolist()
+        print(f"\n------------ Loaded {len(self._entries)} cached embeddings from {self.directory}")
+
+    def _reset(self, dim, model_key):
+        os.makedirs(self.directory, exist_ok=True)
+        self._emb = None
+        self._emb = np.memmap(self._path("embeddings.f32"), dtype=np.float32, mode='w+',
+                              shape=(self.initial_capacity, dim))
+        self._entries, self._free, self._size = {}, [], 0
+        self.dim, self.model_key = dim, model_key
+
+    def _grow(self, capacity):
+        old = np.array(self._emb[:self._size])
+        self._emb.flush()
+        self._emb = None
+        self._emb = np.memmap(self._path("embeddings.f32"), dtype=np.float32, mode='r+',
+                              shape=(capacity, self.dim))
+        self._emb[:len(old)] = old
+
+    def _allocate(self):
+        if self._free:
+            return self._free.pop()
+        if self._size == len(self._emb):
+            self._grow(2 * len(self._emb))
+        self._size += 1
+        return self._size - 1
+
+    def _persist(self):
+        self._emb.flush()
+        ids = np.fromiter(self._entries, dtype=np.int64, count=len(self._entries))
+        values = np.array(list(self._entries.values()), dtype=np.uint64).reshape(-1, 2)
+        tmp = self._path("index.tmp.npz")
+        np.savez(tmp, ids=ids, hashes=values[:, 0], slots=values[:, 1].astype(np.int64),
+                 free=np.array(self._free, dtype=np.int64))
+        os.replace(tmp, self._path("index.npz"))
+        meta = {'dim': self.dim, 'model_key': self.model_key,
+                'capacity': len(self._emb), 'size': self._size}
+        with open(self._path("meta.tmp.json"), "w") as f:
+            json.dump(meta, f)
+        os.replace(self._path("meta.tmp.json"), self._path("meta.json"))
+
+    def get(self, student_ids, features, model, model_key):
+        """
+        Returns (len(student_ids), dim) float32 embeddings for the given
+        students and feature rows. Only students that are new or whose
+        features changed go through `model`, in a single batch.
+        """
+        features = np.asarray(features, dtype=np.float32)
+        hashes = [feature_hash(row) for row in features]
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if self.model_key != model_key or self._emb is None:
+                self._reset(model.mlp2.out_features, model_key)
+
+            slots = np.empty(len(student_ids), dtype=np.int64)
+            missing = []
+            for i, (sid, h) in enumerate(zip(student_ids, hashes)):
+                entry = self._entries.get(int(sid))
+                if entry is not None and entry[0] == h:
+                    slots[i] = entry[1]
+                else:
+                    missing.append(i)
+
+            if missing:
+                with torch.no_grad():
+                    new = model(torch.from_numpy(features[missing])).numpy()
+                for row, i in zip(new, missing):
+                    sid = int(student_ids[i])
+                    entry = self._entries.get(sid)
+                    slot = entry[1] if entry is not None else self._allocate()
+                    self._emb[slot] = row
+                    self._entries[sid] = (hashes[i], slot)
+                    slots[i] = slot
+                self._persist()
+            return np.array(self._emb[slots])
+
+    def invalidate(self, student_id):
+        """Forgets one student's embedding, e.g. after new scores were saved."""
+        with self._lock:
+            entry = self._entries.pop(int(student_id), None)
+            if entry is not None:
+                self._free.append(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries, self._free, self._size = {}, [], 0
+            self.model_key = None
+
+
+embedding_store = EmbeddingStore()
+
+
+def get_student_embeddings(student_ids, features, path=RGCN_CHECKPOINT):
+    """Embeddings of the registry's RGCN checkpoint for the given students, via the store."""
+    model, _ = get_rgcn(path)
+    model_key = f"{os.path.abspath(path)}:{os.path.getmtime(path)}"
+    return embedding_store.get(student_ids, features, model, model_key)
@@ -0,0 +1,361 @@
+# link_table.py
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+
+from database.models import Allocations
+from model.registry import get_rgcn, RGCN_CHECKPOINT
+from model.rgcn.embedding_store import get_student_embeddings, feature_hash
+from model.rgcn.predict_link import LINK_MAP, NO_LINK
+
+LINK_TABLE_DIR = "model/rgcn/cache/links"
+TOP_K = 20
+# source x target pairs scored per LinkPredictor block (bounds the [pairs, hidden] activations)
+BLOCK_PAIRS = 1 << 18
+# above this share of changed students a refresh recomputes the whole table
+FULL_REFRESH_RATIO = 0.25
+
+
+def pair_projections(link_predictor, emb):
+    """
+    Splits LinkPredictor.fc1 over the [emb_u, emb_v] concatenation so each
+    student's source and target halves are projected once; a pair's hidden
+    layer is then relu(U[i] + V[j]) instead of fc1 on a concatenated row.
+    """
+    d = emb.shape[1]
+    W, b = link_predictor.fc1.weight, link_predictor.fc1.bias
+    U = emb @ W[:, :d].T + b
+    V = emb @ W[:, d:].T
+    return U, V, link_predictor.fc2
+
+
+def _top_k_block(U, V, fc2, src_idx, tgt_idx, k):
+    """
+    Scores src_idx x tgt_idx and keeps each source's k most confident
+    predicted links (argmax relation other than no_link, no self pairs).
+
+    Returns (len(src_idx), k) target indices (-1 padded), relations and probabilities.
+    """
+    n_src, n_tgt = len(src_idx), len(tgt_idx)
+    k = min(k, n_tgt)
+    targets = np.full((n_src, k), -1, dtype=np.int64)
+    relations = np.full((n_src, k), NO_LINK, dtype=np.int8)
+    probs = np.zeros((n_src, k), dtype=np.float32)
+    if k == 0:
+        return targets, relations, probs
+
+    tgt = torch.as_tensor(tgt_idx, dtype=torch.long)
+    V_t = V[tgt]
+    rows_per_block = max(1, BLOCK_PAIRS // n_tgt)
+    for start in range(0, n_src, rows_per_block):
+        src = torch.as_tensor(src_idx[start:start + rows_per_block], dtype=torch.long)
+        hidden = torch.relu(U[src][:, None, :] + V_t[None, :, :])        # [B, T, hidden]
+        p, rel = torch.softmax(fc2(hidden), dim=-1).max(dim=-1)          # [B, T]
+        score = torch.where((rel != NO_LINK) & (src[:, None] != tgt[None, :]), p, torch.zeros_like(p))
+        top_p, top_j = score.topk(k, dim=1)
+        top_rel = rel.gather(1, top_j)
+        found = (top_p > 0).numpy()
+        block = slice(start, start + len(src))
+        targets[block] = np.where(found, tgt[top_j].numpy(), -1)
+        relations[block] = np.where(found, top_rel.numpy(), NO_LINK)
+        probs[block] = np.where(found, top_p.numpy(), 0.0)
+    return targets, relations, probs
+
+
+class LinkTable:
+    def __init__(self, unit_id, student_ids, hashes, targets, relations, probs, model_key):
+        """
+        Top-k predicted links of every student in a unit.
+
+        Row i belongs to student_ids[i]; targets holds student IDs (-1 for
+        empty slots), sorted by probability within the row. hashes are the
+        feature hashes the row was computed from, so a refresh can tell which
+        students changed.
+        """
+        self.unit_id     = unit_id
+        self.student_ids = np.asarray(student_ids, dtype=np.int64)
+        self.hashes      = np.asarray(hashes, dtype=np.uint64)
+        self.targets     = targets
+        self.relations   = relations
+        self.probs       = probs
+        self.model_key   = model_key
+        self.row_of      = {int(s): i for i, s in enumerate(self.student_ids)}
+
+    def links_for(self, student_id, min_probability=0.0, link_types=None):
+        """Predicted links from one student as dicts like predict_links returns."""
+        i = self.row_of.get(int(student_id))
+        if i is None:
+            return []
+        results = []
+        for t, k, p in zip(self.targets[i], self.relations[i], self.probs[i]):
+            if t < 0 or p < min_probability:
+                continue
+            if link_types and LINK_MAP[int(k)] not in link_types:
+                continue
+            results.append({
+                'source': int(student_id),
+                'target': int(t),
+                'link_type': LINK_MAP[int(k)],
+                'probability': round(float(p), 2)
+            })
+        return results
+
+    def edges(self, min_probability=0.0):
+        """All stored predictions as (source ids, target ids, relations, probabilities)."""
+        keep = (self.targets >= 0) & (self.probs >= min_probability)
+        src = np.broadcast_to(self.student_ids[:, None], self.targets.shape)
+        return src[keep], self.targets[keep], self.relations[keep], self.probs[keep]
+
+    def save(self, path):
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, student_ids=self.student_ids, hashes=self.hashes, targets=self.targets,
+                 relations=self.relations, probs=self.probs, model_key=np.array(self.model_key))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, unit_id, path):
+        f = np.load(path)
+        return cls(unit_id, f['student_ids'], f['hashes'], f['targets'], f['relations'], f['probs'],
+                   str(f['model_key']))
+
+
+def compute_link_table(unit_id, student_ids, student_data, previous=None, k=TOP_K, path=RGCN_CHECKPOINT):
+    """
+    Builds or incrementally refreshes a unit's LinkTable.
+
+    Predictions only depend on the two students' features (MLP branch), so
+    with a `previous` table from the same checkpoint only students whose
+    feature hash changed, who joined or who left are recomputed: their own
+    rows in full, and every other row against just the changed targets.
+    Rows that lose a stored target while full are recomputed, since their
+    next best link was never stored.
+
+    Args:
+      unit_id: unit the table belongs to
+      student_ids: (N,) real student IDs, row order of student_data
+      student_data: (N x D) feature matrix
+      previous: LinkTable to refresh, or None for a full build
+      k: predictions kept per student
+
+    Returns:
+      (LinkTable, number of rows recomputed in full)
+    """
+    student_ids = np.asarray(student_ids, dtype=np.int64)
+    N = len(student_ids)
+    X = np.asarray(student_data, dtype=np.float32)
+    hashes = np.array([feature_hash(row) for row in X], dtype=np.uint64)
+    model, link_predictor = get_rgcn(path)
+    model_key = f"{os.path.abspath(path)}:{os.path.getmtime(path)}"
+    emb = torch.from_numpy(get_student_embeddings(student_ids.tolist(), X, path))
+
+    with torch.no_grad():
+        U, V, fc2 = pair_projections(link_predictor, emb)
+        k_eff = min(k, N)
+        targets = np.full((N, k_eff), -1, dtype=np.int64)
+        relations = np.full((N, k_eff), NO_LINK, dtype=np.int8)
+        probs = np.zeros((N, k_eff), dtype=np.float32)
+        full = np.ones(N, dtype=bool)
+
+        if previous is not None and previous.model_key == model_key and previous.targets.shape[1] == k_eff:
+            old_rows = np.array([previous.row_of.get(int(s), -1) for s in student_ids])
+            same = old_rows >= 0
+            same[same] = previous.hashes[old_rows[same]] == hashes[same]
+            changed_ids = np.union1d(student_ids[~same],
+                                     np.setdiff1d(previous.student_ids, student_ids))
+            if len(changed_ids) <= FULL_REFRESH_RATIO * N:
+                clean = np.flatnonzero(same)
+                old_t = previous.targets[old_rows[clean]]
+                lost = np.isin(old_t, changed_ids) & (old_t >= 0)
+                # full rows that lost an entry may be missing their next best link
+                refill = lost.any(axis=1) & (old_t[:, -1] >= 0)
+                keep_rows = clean[~refill]
+                full[keep_rows] = False
+
+                # merge the kept entries with predictions against the changed targets
+                new_tgt = np.flatnonzero(~same)
+                kt = old_t[~refill]
+                kp = np.where(lost[~refill], 0.0, previous.probs[old_rows[keep_rows]])
+                kr = previous.relations[old_rows[keep_rows]]
+                kt = np.where(lost[~refill], -1, kt)
+                nt, nr, npb = _top_k_block(U, V, fc2, keep_rows, new_tgt, k_eff)
+                nt = np.where(nt >= 0, student_ids[np.maximum(nt, 0)], -1)
+                cand_t = np.concatenate([kt, nt], axis=1)
+                cand_r = np.concatenate([kr, nr], axis=1)
+                cand_p = np.concatenate([kp, npb], axis=1)
+                order = np.argsort(-cand_p, axis=1, kind='stable')[:, :k_eff]
+                targets[keep_rows] = np.take_along_axis(cand_t, order, axis=1)
+                relations[keep_rows] = np.take_along_axis(cand_r, order, axis=1)
+                probs[keep_rows] = np.take_along_axis(cand_p, order, axis=1)
+
+        rows = np.flatnonzero(full)
+        t, r, p = _top_k_block(U, V, fc2, rows, np.arange(N), k_eff)
+        targets[rows] = np.where(t >= 0, student_ids[np.maximum(t, 0)], -1)
+        relations[rows] = r
+        probs[rows] = p
+
+    table = LinkTable(unit_id, student_ids, hashes, targets, relations, probs, model_key)
+    return table, len(rows)
+
+
+class LinkTableStore:
+    def __init__(self, directory=LINK_TABLE_DIR, k=TOP_K):
+        """
+        Per-unit LinkTables kept in memory and as unit_<id>.npz files.
+
+        Tables are refreshed by a background thread (start_worker) for units
+        that were scheduled or that contain a student whose scores were
+        saved; readers get the last finished table and never run the model.
+        Saved scores also leave a unit_<id>.stale marker next to the file,
+        so other processes sharing the directory see that the table is out
+        of date; a table file that changed on disk is reloaded.
+        """
+        self.directory = directory
+        self.k = k
+        self._tables = {}
+        self._mtimes = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._worker = None
+
+    def _path(self, unit_id):
+        return os.path.join(self.directory, f"unit_{unit_id}.npz")
+
+    def _stale_path(self, unit_id):
+        return os.path.join(self.directory, f"unit_{unit_id}.stale")
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def is_stale(self, unit_id):
+        """True when scores of the unit were saved after its table file was written."""
+        marked = self._mtime(self._stale_path(unit_id))
+        return marked is not None and marked >= (self._mtime(self._path(unit_id)) or 0.0)
+
+    def get(self, unit_id):
+        """
+        Returns the unit's last computed LinkTable, or None when there is
+        none yet. A stale table is still returned, and its refresh is
+        queued.
+        """
+        mtime = self._mtime(self._path(unit_id))
+        with self._lock:
+            table = self._tables.get(unit_id)
+            if mtime is not None and (table is None or self._mtimes.get(unit_id) != mtime):
+                table = LinkTable.load(unit_id, self._path(unit_id))
+                self._tables[unit_id] = table
+                self._mtimes[unit_id] = mtime
+        if table is not None and self.is_stale(unit_id):
+            self.schedule(unit_id)
+        return table
+
+    def refresh(self, db, unit_id):
+        """Brings a unit's table up to date with its current scores and persists it."""
+        from model.unit_cache import unit_cache
+
+        start = time.perf_counter()
+        marked = self._mtime(self._stale_path(unit_id))
+        if marked is not None:
+            # scores may have been saved by another process: read them afresh
+            unit_cache.invalidate(unit_id)
+        snap = unit_cache.get(db, unit_id)
+        with snap.lock:
+            student_ids = sorted(snap.id_map, key=snap.id_map.get)
+            student_data = snap.student_data.copy()
+        table, recomputed = compute_link_table(unit_id, student_ids, student_data,
+                                               previous=self.get(unit_id), k=self.k)
+        os.makedirs(self.directory, exist_ok=True)
+        table.save(self._path(unit_id))
+        # keep a marker written during the refresh, its scores may have been missed
+        if marked is not None and self._mtime(self._stale_path(unit_id)) == marked:
+            os.remove(self._stale_path(unit_id))
+        with self._lock:
+            self._tables[unit_id] = table
+            self._mtimes[unit_id] = self._mtime(self._path(unit_id))
+        print(f"\n------------ Link table of unit {unit_id}: {recomputed}/{len(student_ids)} rows "
+              f"recomputed in {time.perf_counter() - start:.2f}s")
+        return table
+
+    def schedule(self, unit_id):
+        """Queues a refresh of `unit_id` for the background worker."""
+        with self._lock:
+            self._pending.add(unit_id)
+        self._wake.set()
+
+    def mark_dirty(self, student_id, db=None):
+        """
+        Marks the tables of every unit of `student_id` stale on disk and
+        queues their refresh. Units come from the loaded tables and, with
+        `db`, from the student's allocations.
+        """
+        with self._lock:
+            units = {u for u, t in self._tables.items() if int(student_id) in t.row_of}
+        if db is not None:
+            units.update(u for (u,) in db.query(Allocations.unit_id).filter_by(student_id=int(student_id)).all())
+        for unit_id in units:
+            if os.path.exists(self._path(unit_id)):
+                with open(self._stale_path(unit_id), "w"):
+                    pass
+            self.schedule(unit_id)
+
+    def start_worker(self, session_factory, debounce=2.0):
+        """
+        Starts the daemon thread that refreshes scheduled units. It waits
+        `debounce` seconds after a wake-up so a burst of saved surveys is
+        handled by one refresh.
+        """
+        if self._worker is not None:
+            return self._worker
+
+        def run():
+            while True:
+                self._wake.wait()
+                time.sleep(debounce)
+                self._wake.clear()
+                with self._lock:
+                    units, self._pending = self._pending, set()
+                for unit_id in units:
+                    db = session_factory()
+                    try:
+                        self.refresh(db, unit_id)
+                    except Exception as e:
+                        print(f"\n------------ Link table refresh of unit {unit_id} failed: {e}")
+                    finally:
+                        db.close()
+
+        self._worker = threading.Thread(target=run, name="link-table-worker", daemon=True)
+        self._worker.start()
+        return self._worker
+
+
+link_tables = LinkTableStore()
+
+
+if __name__ == "__main__":
+    from database.db import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Precompute the predicted-link tables of units.")
+    parser.add_argument("--unit-id", type=int, action="append",
+                        help="unit to refresh (repeatable); every allocated unit by default")
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    parser.add_argument("--rebuild", action="store_true", help="ignore stored tables and recompute fully")
+    args = parser.parse_args()
+
+    store = LinkTableStore(k=args.top_k)
+    db = SessionLocal()
+    try:
+        units = args.unit_id or [u for (u,) in db.query(Allocations.unit_id).distinct().all()]
+        for unit_id in units:
+            if args.rebuild and os.path.exists(store._path(unit_id)):
+                os.remove(store._path(unit_id))
+            store.refresh(db, unit_id)
+    finally:
+        db.close()
@@ -1,44 +1,52 @@
 import torch
 import torch.nn.functional as F
 
-def predict_links(x, model, link_predictor, source, targets, id_map):
-    link_map = {
-        0: "friends",
-        1: "influence",
-        2: "feedback",
-        3: "more_time",
-        4: "advice",
-        5: "disrespect",
-        6: "no_link"
-    }
+LINK_MAP = {
+    0: "friends",
+    1: "influence",
+    2: "feedback",
+    3: "more_time",
+    4: "advice",
+    5: "disrespect",
+    6: "no_link"
+}
+NO_LINK = 6
+# minimum softmax probability for a predicted link to be reported
+PREDICTION_THRESHOLD = 0.95
 
+def predict_links(x, model, link_predictor, source, targets, id_map, emb=None):
+    """
+    Predicts the most likely relation from `source` to every index in
+    `targets` with one LinkPredictor forward pass over all pairs, and keeps
+    the confident (>= PREDICTION_THRESHOLD) predictions other than no_link.
+    Precomputed embeddings (e.g. from the embedding store) can be passed as
+    `emb` to skip the model forward pass.
+    """
     # build reverse map: internal idx → real student ID
     rev_map = {idx: real_id for real_id, idx in id_map.items()}
+    if len(targets) == 0:
+        return []
 
     model.eval()
     link_predictor.eval()
     with torch.no_grad():
-        emb = model(x)  # distilled MLP branch
-        src_emb = emb[source].unsqueeze(0)
-        real_source = rev_map[source]
-        results = []
+        if emb is None:
+            emb = model(x)  # distilled MLP branch
+        tgt_idx = torch.as_tensor(targets, dtype=torch.long)
+        tgt_emb = emb[tgt_idx]                                   # [T, emb]
+        src_emb = emb[source].unsqueeze(0).expand_as(tgt_emb)    # [T, emb]
+        logits = link_predictor(src_emb, tgt_emb)                # [T, num_relations]
+        probs, pred_idx = F.softmax(logits, dim=1).max(dim=1)
+        keep = (probs >= PREDICTION_THRESHOLD) & (pred_idx != NO_LINK)
 
-        for tgt in targets:
-            tgt_emb = emb[tgt].unsqueeze(0)
-            logits = link_predictor(src_emb, tgt_emb)        # [1, num_relations]
-            probs  = F.softmax(logits, dim=1).squeeze(0)     # [num_relations]
-            pred_idx = probs.argmax().item()
-            pred_type = link_map[pred_idx]
-
-            real_tgt   = rev_map[tgt]
-            pred_prob  = probs[pred_idx].item()
-            
-            if pred_prob >= 0.95 and pred_type != "no_link":
-                results.append({
-                    'source': real_source,
-                    'target': real_tgt,
-                    'link_type': pred_type,
-                    'probability': round(pred_prob,2)
-                })
+    real_source = rev_map[source]
+    results = []
+    for t, p, k in zip(tgt_idx[keep].tolist(), probs[keep].tolist(), pred_idx[keep].tolist()):
+        results.append({
+            'source': real_source,
+            'target': rev_map[t],
+            'link_type': LINK_MAP[k],
+            'probability': round(p,2)
+        })
 
     return results
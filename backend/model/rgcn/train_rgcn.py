@@ -0,0 +1,281 @@
+# train_rgcn.py
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+
+from database.models import Allocations, CalculatedScores, Relationships
+from model.registry import RGCN_CHECKPOINT
+from model.rgcn.rgcn_linkpred import InductiveRGCN, LinkPredictor
+from model.rgcn.predict_link import LINK_MAP, NO_LINK
+from model_utils import map_link_types, map_student_ids, create_data_object
+
+# six link types plus no_link, which negative pairs are labelled with
+NUM_RELATIONS = len(LINK_MAP)
+
+
+def load_training_graph(db, unit_ids=None):
+    """
+    Builds one PyG Data object from the DB: the students of `unit_ids`, or
+    every student with calculated scores when unit_ids is None, and all
+    relationships among them. Students appearing in several units are one
+    node, so pooled schools share a single graph.
+    """
+    if unit_ids:
+        student_ids = [s for (s,) in db.query(Allocations.student_id)
+                                       .filter(Allocations.unit_id.in_(unit_ids)).distinct().all()]
+    else:
+        student_ids = [s for (s,) in db.query(CalculatedScores.student_id).all()]
+    if not student_ids:
+        raise ValueError(f"No students found for units {unit_ids}")
+    scores = db.query(CalculatedScores).filter(CalculatedScores.student_id.in_(student_ids)).all()
+    relationships = db.query(Relationships).filter(Relationships.source.in_(student_ids),
+                                                   Relationships.target.in_(student_ids)).all()
+    if not scores or not relationships:
+        raise ValueError("Training needs both student scores and relationships")
+    scores_df = pd.DataFrame([obj.to_dict() for obj in scores])
+    rel_df = map_link_types(pd.DataFrame([obj.to_dict() for obj in relationships]))
+    scores_df, edges_df, id_map = map_student_ids(scores_df, rel_df)
+    return create_data_object(scores_df, edges_df), id_map
+
+
+class NeighbourSampler:
+    def __init__(self, edge_index, edge_type, num_nodes, fanouts=(10, 10), edge_ids=None):
+        """
+        Samples the k-hop in-neighbourhood RGCNConv aggregates over, with at
+        most fanouts[h] incoming edges per node at hop h. Edges are kept in
+        CSR order by target so a hop is a few vectorised numpy calls.
+        `edge_ids` names the edges for sample(exclude_edges=...) and
+        defaults to their column positions.
+        """
+        src, dst = np.asarray(edge_index[0]), np.asarray(edge_index[1])
+        order = np.argsort(dst, kind='stable')
+        self.src = src[order]
+        self.dst = dst[order]
+        self.edge_type = np.asarray(edge_type)[order]
+        self.edge_id = order if edge_ids is None else np.asarray(edge_ids)[order]
+        self.ptr = np.concatenate([[0], np.cumsum(np.bincount(dst, minlength=num_nodes))])
+        self.fanouts = fanouts
+
+    def sample(self, seeds, rng, exclude_edges=None):
+        """
+        Args:
+          seeds: node ids whose embeddings are needed
+          rng: np.random.Generator
+          exclude_edges: original edge ids never used for message passing
+                         (the supervised edges of the batch)
+
+        Returns:
+          nodes      -- (n,) distinct global node ids
+          edge_index -- (2 x m) local edge index
+          edge_type  -- (m,)
+          seed_pos   -- (len(seeds),) row of each seed in nodes
+        """
+        seeds = np.asarray(seeds, dtype=np.int64)
+        frontier = np.unique(seeds)
+        picked = []
+        for fanout in self.fanouts:
+            deg = self.ptr[frontier + 1] - self.ptr[frontier]
+            has = deg > 0
+            frontier, deg = frontier[has], deg[has]
+            if len(frontier) == 0:
+                break
+            # fanout draws with replacement per node, deduplicated below
+            offsets = (rng.random((len(frontier), fanout)) * deg[:, None]).astype(np.int64)
+            positions = np.unique((self.ptr[frontier][:, None] + offsets).ravel())
+            picked.append(positions)
+            frontier = np.unique(self.src[positions])
+
+        positions = np.unique(np.concatenate(picked)) if picked else np.zeros(0, dtype=np.int64)
+        if exclude_edges is not None and len(positions):
+            positions = positions[~np.isin(self.edge_id[positions], exclude_edges)]
+        src, dst = self.src[positions], self.dst[positions]
+
+        nodes = np.unique(np.concatenate([seeds, src, dst]))
+        local = lambda ids: np.searchsorted(nodes, ids)
+        edge_index = np.stack([local(src), local(dst)])
+        return nodes, edge_index, self.edge_type[positions], local(seeds)
+
+
+def sample_negatives(num_nodes, num, edge_keys, rng):
+    """Random ordered pairs that are neither self pairs nor reported links (label no_link)."""
+    src = rng.integers(0, num_nodes, 2 * num + 16)
+    dst = rng.integers(0, num_nodes, 2 * num + 16)
+    ok = (src != dst) & ~np.isin(src * num_nodes + dst, edge_keys)
+    return src[ok][:num], dst[ok][:num]
+
+
+def _pair_batch(src, dst, labels, sampler, x, model, rng, exclude_edges=None):
+    """Embeds both endpoints of a pair batch on one sampled subgraph; returns (emb_u, emb_v, labels)."""
+    seeds = np.concatenate([src, dst])
+    nodes, edge_index, edge_type, seed_pos = sampler.sample(seeds, rng, exclude_edges)
+    emb = model(x[torch.as_tensor(nodes)],
+                torch.as_tensor(edge_index, dtype=torch.long),
+                torch.as_tensor(edge_type, dtype=torch.long))[torch.as_tensor(seed_pos)]
+    n = len(src)
+    return emb[:n], emb[n:2 * n], torch.as_tensor(labels, dtype=torch.long)
+
+
+def train_rgcn(data, hidden_channels=128, out_channels=64, link_hidden_dim=128, fanouts=(10, 10),
+               epochs=20, batch_size=512, neg_ratio=1.0, lr=0.005, distill_epochs=50,
+               val_ratio=0.1, seed=0, verbose=True):
+    """
+    Trains InductiveRGCN + LinkPredictor on neighbour-sampled mini-batches
+    and distils the RGCN embeddings into the MLP branch used at inference.
+
+    Each step supervises `batch_size` reported links (labels 0-5) and
+    neg_ratio times as many random unlinked pairs (label 6, no_link). The
+    supervised links are removed from the sampled subgraph so the model
+    cannot read them off its input. `val_ratio` of the links are held out
+    of the graph entirely and scored after each stage.
+
+    Returns:
+      model, link_predictor, metrics dict
+    """
+    rng = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+    x = data.x.float()
+    N, in_channels = x.shape
+    edge_index = data.edge_index.numpy()
+    edge_type = data.edge_attr.numpy()
+    edge_keys = np.unique(edge_index[0] * N + edge_index[1])
+
+    perm = rng.permutation(edge_index.shape[1])
+    n_val = int(len(perm) * val_ratio)
+    val_ids, train_ids = perm[:n_val], perm[n_val:]
+    sampler = NeighbourSampler(edge_index[:, train_ids], edge_type[train_ids], N, fanouts, edge_ids=train_ids)
+    val_neg = sample_negatives(N, int(n_val * neg_ratio), edge_keys, rng)
+    val_pairs = (np.concatenate([edge_index[0, val_ids], val_neg[0]]),
+                 np.concatenate([edge_index[1, val_ids], val_neg[1]]),
+                 np.concatenate([edge_type[val_ids], np.full(len(val_neg[0]), NO_LINK)]))
+
+    model = InductiveRGCN(in_channels, hidden_channels, out_channels, NUM_RELATIONS)
+    link_predictor = LinkPredictor(out_channels, link_hidden_dim, NUM_RELATIONS)
+    optimizer = torch.optim.Adam(list(model.conv1.parameters()) + list(model.conv2.parameters()) +
+                                 list(link_predictor.parameters()), lr=lr)
+
+    def evaluate(use_mlp):
+        model.eval(); link_predictor.eval()
+        src, dst, labels = val_pairs
+        if len(src) == 0:
+            return None
+        with torch.no_grad():
+            if use_mlp:
+                emb = model(x)
+                logits = link_predictor(emb[torch.as_tensor(src)], emb[torch.as_tensor(dst)])
+            else:
+                e_u, e_v, _ = _pair_batch(src, dst, labels, sampler, x, model, rng)
+                logits = link_predictor(e_u, e_v)
+        pred = logits.argmax(dim=1).numpy()
+        linked = labels != NO_LINK
+        return {'accuracy': round(float((pred == labels).mean()), 4),
+                'link_accuracy': round(float((pred[linked] == labels[linked]).mean()), 4) if linked.any() else None}
+
+    # --- stage 1: RGCN path on sampled subgraphs ---
+    start = time.perf_counter()
+    for epoch in range(epochs):
+        model.train(); link_predictor.train()
+        order = rng.permutation(train_ids)
+        total = 0.0
+        for b in range(0, len(order), batch_size):
+            pos = order[b:b + batch_size]
+            neg_src, neg_dst = sample_negatives(N, int(len(pos) * neg_ratio), edge_keys, rng)
+            src = np.concatenate([edge_index[0, pos], neg_src])
+            dst = np.concatenate([edge_index[1, pos], neg_dst])
+            labels = np.concatenate([edge_type[pos], np.full(len(neg_src), NO_LINK)])
+            e_u, e_v, y = _pair_batch(src, dst, labels, sampler, x, model, rng, exclude_edges=pos)
+            loss = F.cross_entropy(link_predictor(e_u, e_v), y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(src)
+        if verbose:
+            print(f"RGCN epoch {epoch + 1}/{epochs}: loss = {total / max(1, len(order) * (1 + neg_ratio)):.4f}")
+    rgcn_metrics = evaluate(use_mlp=False)
+    print(f"\n------------ RGCN stage done in {time.perf_counter() - start:.1f}s, validation: {rgcn_metrics}")
+
+    # --- stage 2: distil the RGCN embeddings into the MLP branch ---
+    model.eval()
+    teacher = torch.zeros(N, out_channels)
+    with torch.no_grad():
+        for b in range(0, N, batch_size):
+            seeds = np.arange(b, min(N, b + batch_size))
+            nodes, ei, et, seed_pos = sampler.sample(seeds, rng)
+            teacher[seeds] = model(x[torch.as_tensor(nodes)], torch.as_tensor(ei, dtype=torch.long),
+                                   torch.as_tensor(et, dtype=torch.long))[torch.as_tensor(seed_pos)]
+
+    mlp_params = list(model.mlp1.parameters()) + list(model.mlp2.parameters())
+    distill_opt = torch.optim.Adam(mlp_params, lr=lr)
+    for epoch in range(distill_epochs):
+        model.train()
+        order = rng.permutation(N)
+        total = 0.0
+        for b in range(0, N, batch_size):
+            idx = torch.as_tensor(order[b:b + batch_size])
+            loss = F.mse_loss(model(x[idx]), teacher[idx])
+            distill_opt.zero_grad()
+            loss.backward()
+            distill_opt.step()
+            total += loss.item() * len(idx)
+        if verbose and (epoch + 1) % 10 == 0:
+            print(f"Distill epoch {epoch + 1}/{distill_epochs}: mse = {total / N:.5f}")
+    mlp_metrics = evaluate(use_mlp=True)
+    print(f"\n------------ Distillation done, MLP validation: {mlp_metrics}")
+
+    model.eval()
+    link_predictor.eval()
+    metrics = {'rgcn': rgcn_metrics, 'mlp': mlp_metrics,
+               'nodes': N, 'edges': int(edge_index.shape[1]), 'seconds': round(time.perf_counter() - start, 1)}
+    return model, link_predictor, metrics
+
+
+def save_rgcn_checkpoint(model, link_predictor, path=RGCN_CHECKPOINT):
+    """Writes the checkpoint layout load_rgcn reads; replaced atomically for running servers."""
+    ckpt = {
+        'rgcn_state':      model.state_dict(),
+        'linkpred_state':  link_predictor.state_dict(),
+        'in_channels':     model.mlp1.in_features,
+        'hidden_channels': model.mlp1.out_features,
+        'out_channels':    model.mlp2.out_features,
+        'num_relations':   link_predictor.fc2.out_features,
+        'link_hidden_dim': link_predictor.fc1.out_features,
+    }
+    tmp = path + ".tmp"
+    torch.save(ckpt, tmp)
+    os.replace(tmp, path)
+    print(f"---------------- Saved RGCN checkpoint to {path}")
+
+
+if __name__ == "__main__":
+    from database.db import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Train the RGCN link predictor with neighbour sampling.")
+    parser.add_argument("--unit-id", type=int, action="append",
+                        help="unit to train on (repeatable); every student with scores by default")
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--distill-epochs", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=512)
+    parser.add_argument("--fanouts", type=int, nargs="+", default=[10, 10])
+    parser.add_argument("--neg-ratio", type=float, default=1.0)
+    parser.add_argument("--lr", type=float, default=0.005)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=None, help="torch threads (default: all cores)")
+    parser.add_argument("--out", default=RGCN_CHECKPOINT)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads or os.cpu_count() or 1)
+    db = SessionLocal()
+    try:
+        data, _ = load_training_graph(db, args.unit_id)
+    finally:
+        db.close()
+
+    model, link_predictor, metrics = train_rgcn(data, fanouts=tuple(args.fanouts), epochs=args.epochs,
+                                                batch_size=args.batch_size, neg_ratio=args.neg_ratio,
+                                                lr=args.lr, distill_epochs=args.distill_epochs, seed=args.seed)
+    print(f"\n---------------- {metrics}")
+    save_rgcn_checkpoint(model, link_predictor, args.out)
@@ -0,0 +1,171 @@
+# unit_cache.py
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import func
+
+from database.models import Allocations, CalculatedScores, Relationships
+from model.dqn.allocation_env import StudentAllocationEnv, precompute_link_matrices, replace_out_links
+from model_utils import load_unit_graph, EDGE_TYPES
+
+# same column order create_data_object gives the feature matrix
+FEATURE_COLUMNS = [c.name for c in CalculatedScores.__table__.columns if c.name != 'student_id']
+
+
+class UnitSnapshot:
+    def __init__(self, unit_id, data, id_map, alloc_rows):
+        """
+        Cached model inputs of one unit: the feature matrix, the link store,
+        the current class labels and (once requested) an env loaded with
+        those labels. Students whose scores or links were saved since the
+        snapshot was built are refreshed row by row on the next use.
+        """
+        self.unit_id      = unit_id
+        self.id_map       = id_map
+        self.student_data = data.x.cpu().numpy()
+        self.E            = precompute_link_matrices(data)
+        self.labels       = np.full(len(id_map), -1, dtype=np.int64)
+        for sid, cls in alloc_rows:
+            if sid in id_map and cls is not None:
+                self.labels[id_map[sid]] = cls
+        self.roster_ids     = {sid for sid, _ in alloc_rows}
+        self.roster_size    = len(alloc_rows)
+        self.built_at       = time.monotonic()
+        self.dirty_features = set()
+        self.dirty_links    = set()
+        self.stale          = False
+        self.env            = None
+        self._env_key       = None
+        # held by callers while they read or move students
+        self.lock = threading.RLock()
+
+    def get_env(self, num_classes, target_class_size, target_feature_avgs):
+        """
+        Returns the env holding the current labels, rebuilding it only when
+        the class configuration changed.
+        """
+        key = (num_classes, target_class_size, np.asarray(target_feature_avgs).tobytes())
+        if self.env is None or self._env_key != key:
+            if self.labels.max() >= num_classes:
+                raise ValueError(f"Unit {self.unit_id} has allocations outside {num_classes} classes")
+            env = StudentAllocationEnv(num_classes, target_class_size, target_feature_avgs, self.E)
+            env.load_assignment(self.labels, self.student_data)
+            self.env, self._env_key = env, key
+        return self.env
+
+    def set_labels(self, updates):
+        """Records {student index: class} moves that were saved to the DB."""
+        for idx, cls in updates.items():
+            self.labels[idx] = cls
+
+    def refresh(self, db):
+        """Pulls the score and link rows of dirty students and patches them in."""
+        if self.dirty_features:
+            # swap first so marks arriving meanwhile wait for the next refresh
+            dirty, self.dirty_features = self.dirty_features, set()
+            rows = (db.query(CalculatedScores)
+                      .filter(CalculatedScores.student_id.in_(list(dirty)))
+                      .all())
+            for row in rows:
+                idx = self.id_map.get(row.student_id)
+                if idx is None:
+                    continue
+                feats = np.array([getattr(row, c) for c in FEATURE_COLUMNS], dtype=np.float32)
+                if self.env is not None and self.env.assignment[idx] >= 0:
+                    self.env.sum_features[self.env.assignment[idx]] += feats - self.student_data[idx]
+                self.student_data[idx] = feats
+            print(f"\n------------ Refreshed scores of {len(rows)} student(s) in unit {self.unit_id}")
+
+        if self.dirty_links:
+            dirty, self.dirty_links = self.dirty_links, set()
+            roster = db.query(Allocations.student_id).filter_by(unit_id=self.unit_id)
+            rows = (db.query(Relationships.source, Relationships.target, Relationships.link_type)
+                      .filter(Relationships.source.in_(list(dirty)),
+                              Relationships.target.in_(roster))
+                      .all())
+            if any(t not in self.id_map for _, t, _ in rows):
+                # a new node joined the graph: rebuild instead of patching
+                self.stale = True
+                return
+            edges = np.array([(self.id_map[s], self.id_map[t], EDGE_TYPES[lt])
+                              for s, t, lt in rows if s in self.id_map and lt in EDGE_TYPES],
+                             dtype=np.int64).reshape(-1, 3)
+            src, dst, lbl = edges.T
+            sources = [self.id_map[s] for s in dirty if s in self.id_map]
+            self.E = replace_out_links(self.E, sources, src, dst, lbl.astype(np.int8))
+            if self.env is not None:
+                self.env.E = self.E
+                for s in sources:
+                    self.env.refresh_out_links(s)
+            print(f"\n------------ Refreshed links of {len(sources)} student(s) in unit {self.unit_id}")
+
+
+class UnitCache:
+    def __init__(self, max_age=600, max_units=8):
+        """
+        Per-process cache of UnitSnapshots keyed by unit id.
+
+        A snapshot is rebuilt when the unit's roster size changes, when it
+        is older than `max_age` seconds (other worker processes may have
+        written allocations) or after invalidate(). Only `max_units`
+        snapshots are kept; the least recently built one is dropped first.
+        """
+        self.max_age = max_age
+        self.max_units = max_units
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def get(self, db, unit_id):
+        """Returns an up-to-date snapshot of `unit_id`, building it if needed."""
+        roster_size = db.query(func.count(Allocations.student_id)).filter_by(unit_id=unit_id).scalar()
+        with self._lock:
+            snap = self._snapshots.get(unit_id)
+            if (snap is None or snap.stale or snap.roster_size != roster_size or
+                    time.monotonic() - snap.built_at > self.max_age):
+                snap = self._build(db, unit_id)
+        with snap.lock:
+            snap.refresh(db)
+        if snap.stale:
+            with self._lock:
+                snap = self._build(db, unit_id)
+        return snap
+
+    def _build(self, db, unit_id):
+        print(f"\n------------ Building snapshot of unit {unit_id}")
+        data, id_map = load_unit_graph(db, unit_id)
+        alloc_rows = (db.query(Allocations.student_id, Allocations.class_id)
+                        .filter_by(unit_id=unit_id)
+                        .all())
+        snap = UnitSnapshot(unit_id, data, id_map, alloc_rows)
+        self._snapshots[unit_id] = snap
+        while len(self._snapshots) > self.max_units:
+            oldest = min(self._snapshots, key=lambda u: self._snapshots[u].built_at)
+            del self._snapshots[oldest]
+        return snap
+
+    def mark_features_dirty(self, student_id):
+        self._mark(student_id, 'dirty_features')
+
+    def mark_links_dirty(self, student_id):
+        self._mark(student_id, 'dirty_links')
+
+    def _mark(self, student_id, kind):
+        with self._lock:
+            for snap in self._snapshots.values():
+                if student_id in snap.id_map:
+                    getattr(snap, kind).add(student_id)
+                elif student_id in snap.roster_ids:
+                    # first scores or links of a student outside the graph
+                    snap.stale = True
+
+    def invalidate(self, unit_id=None):
+        """Drops one unit's snapshot, or every snapshot when unit_id is None."""
+        with self._lock:
+            if unit_id is None:
+                self._snapshots.clear()
+            else:
+                self._snapshots.pop(unit_id, None)
+
+
+unit_cache = UnitCache()
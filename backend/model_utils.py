@@ -8,29 +8,45 @@ from database.models import Students, Clubs, Users, Teachers, SurveyResponse, Re
 import torch
 from torch_geometric.data import Data
 from model.rgcn.rgcn_linkpred import InductiveRGCN, LinkPredictor
+from model.registry import get_rgcn, RGCN_CHECKPOINT
 from model.dqn.train_predict import *
 
-def generate_dataframes(db, user_id):
-    teacher = db.query(Teachers).filter_by(emp_id=user_id).first()
-    if not teacher:
-        return jsonify({"message": "Invalid teacher account"}), 401
-    unit_id = teacher.manage_unit
+def query_unit_frames(db, unit_id):
+    """
+    Reads the calculated scores of a unit's students and the relationships
+    between them.
+
+    Returns:
+      (scores_df, rel_df) with one row per student and per relationship
+
+    Raises:
+      ValueError when the unit has no students, scores or links
+    """
     student_id_rows = db.query(Allocations.student_id).filter_by(unit_id=unit_id).all()
     student_ids = [row[0] for row in student_id_rows]
     if not student_ids:
-        return jsonify({"message": "No students allocated to this unit"}), 401
+        raise ValueError("No students allocated to this unit")
     calculated_scores = db.query(CalculatedScores).filter(CalculatedScores.student_id.in_(student_ids)).all()
     if not calculated_scores:
-        return jsonify({"message": "No students scores found"}), 401
+        raise ValueError("No students scores found")
     relationships = db.query(Relationships).filter(Relationships.source.in_(student_ids),Relationships.target.in_(student_ids)).all()
     if not relationships:
-        return jsonify({"message": "No relationships found"}), 401
+        raise ValueError("No relationships found")
     print("\n------------  Creating list of dict from calculated scores")
     scores_list = [ obj.to_dict() for obj in calculated_scores ]
     print("\n------------  Creating list of dict from relationship scores")
     relationships_list = [ obj.to_dict() for obj in relationships ]
-    rel_df = pd.DataFrame(relationships_list)
-    scores_df = pd.DataFrame(scores_list)
+    return pd.DataFrame(scores_list), pd.DataFrame(relationships_list)
+
+def generate_dataframes(db, user_id):
+    teacher = db.query(Teachers).filter_by(emp_id=user_id).first()
+    if not teacher:
+        return jsonify({"message": "Invalid teacher account"}), 401
+    unit_id = teacher.manage_unit
+    try:
+        scores_df, rel_df = query_unit_frames(db, unit_id)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 401
     print("\n------------ Scores DataFrame columns: \n", scores_df.columns)
     print("\n------------ Scores DataFrame shape: \n", scores_df.shape)
     print("\n------------ Relationships DataFrame columns: \n", rel_df.columns)
@@ -38,8 +54,7 @@ def generate_dataframes(db, user_id):
     print("\n------------ Finished generating datafrane")
     return unit_id,scores_df, rel_df
 
-def map_link_types(rel_df):
-    edge_types = {
+EDGE_TYPES = {
     'friends' : 0,
     'influence' : 1,
     'feedback': 2,
@@ -47,9 +62,11 @@ def map_link_types(rel_df):
     'advice': 4,
     'disrespect': 5
     }
+
+def map_link_types(rel_df):
     print("\n------------ Starting mapping link types")
     print(rel_df['link_type'].unique())
-    rel_df['edge_type'] = rel_df['link_type'].map(edge_types).astype(np.int64)
+    rel_df['edge_type'] = rel_df['link_type'].map(EDGE_TYPES).astype(np.int64)
 
     print("\n------------ Finished mapping link types")
     return rel_df
@@ -108,6 +125,35 @@ def create_data_object(student_df, edges_df):
      
     return data
 
+def load_unit_graph(db, unit_id):
+    """
+    Builds the PyG Data object and id_map of a unit straight from the DB,
+    for use outside a request (training and precompute jobs).
+    Raises ValueError when the unit has no students, scores or links.
+    """
+    scores_df, rel_df = query_unit_frames(db, unit_id)
+    scores_df, edges_df, id_map = map_student_ids(scores_df, map_link_types(rel_df))
+    data = create_data_object(scores_df, edges_df)
+    return data, id_map
+
+def load_csv_graph(survey_path="data/survey_responses.csv", relationships_path="data/relationships.csv"):
+    """
+    Builds the PyG Data object and id_map from the survey and relationship
+    CSVs that load_data.py imports, so models can be trained without a
+    database. Features are computed as in load_calculate_scores.
+    """
+    # both modules import this one
+    from model.unit_cache import FEATURE_COLUMNS
+    from utils import normalizeResponse, calculateFeatures
+    survey_df = pd.read_csv(survey_path).rename(columns={'Participant-ID': 'student_id'})
+    scores_df = calculateFeatures(normalizeResponse(survey_df)).round(3)
+    scores_df = scores_df[['student_id'] + FEATURE_COLUMNS]
+    rel_df = pd.read_csv(relationships_path).rename(columns={'Source': 'source', 'Target': 'target'})
+    rel_df = map_link_types(rel_df)
+    scores_df, edges_df, id_map = map_student_ids(scores_df, rel_df)
+    data = create_data_object(scores_df, edges_df)
+    return data, id_map
+
 def save_allocation_summary(unit_id, allocation_summary, db):
 
     # convert each dict into an AllocationsSummary ORM instance
@@ -133,9 +179,9 @@ def save_allocations(db_session, env, id_map, unit_id):
               .update({'class_id': None}, synchronize_session=False)
     upserted = 0
     map_id = {v: int(k) for k, v in id_map.items()}
-    # 2) Walk through your env.state to apply the new class assignments
-    for class_idx, cls in enumerate(env.state):
-        for internal_idx in cls['student_indices']:
+    # 2) Walk through the env class members to apply the new class assignments
+    for class_idx, members in enumerate(env.members):
+        for internal_idx in members:
             student_id = map_id[internal_idx]
             # Try to fetch an existing row
             alloc = (db_session.query(Allocations)
@@ -160,6 +206,26 @@ def save_allocations(db_session, env, id_map, unit_id):
     db_session.commit()
     return upserted
 
+def summary_target_matrix(summary_rows):
+    """
+    Build the (num_classes × feature_dim) target matrix stored in a unit's
+    AllocationsSummary rows (ordered by class_id), in feature-matrix column order.
+    """
+    target_attrs = [
+        'target_academic_engagement_score',
+        'target_academic_wellbeing_score',
+        'target_mental_health_score',
+        'target_growth_mindset_score',
+        'target_gender_norm_score',
+        'target_social_attitude_score',
+        'target_school_environment_score'
+    ]
+    target_vals = [
+    [float(getattr(r, attr)) for attr in target_attrs]
+    for r in summary_rows
+    ]
+    return np.array(target_vals, dtype=float)
+
 def generate_target_matrix(target_values: list[dict]) -> np.ndarray:
     """
     Build a (num_classes × feature_dim) matrix from the list of target‐value dicts.
@@ -190,23 +256,8 @@ def generate_target_matrix(target_values: list[dict]) -> np.ndarray:
     return mat
 
 def returnRgcnLinkPred():
-    ckpt = torch.load("model/rgcn/rgcn_linkpred_checkpoint.pth", map_location='cpu')
-    in_channels      = ckpt['in_channels']
-    hidden_channels  = ckpt['hidden_channels']
-    out_channels     = ckpt['out_channels']
-    num_relations    = ckpt['num_relations']
-    link_hidden_dim  = ckpt['link_hidden_dim']
-
-    model = InductiveRGCN(in_channels, hidden_channels, out_channels, num_relations)
-    link_predictor = LinkPredictor(out_channels, link_hidden_dim, num_relations)
-
-    model.load_state_dict(     ckpt['rgcn_state'])
-    link_predictor.load_state_dict(ckpt['linkpred_state'])
-    
-    model.eval()
-    link_predictor.eval()
-
-    return model, link_predictor
+    """Returns the cached eval-mode (model, link_predictor) pair from the model registry."""
+    return get_rgcn(RGCN_CHECKPOINT)
 
 def generate_dataframes_by_classid(db, user_id, class_id,student_id):
     teacher = db.query(Teachers).filter_by(emp_id=user_id).first()
@@ -267,25 +318,13 @@ def get_non_relationship_ids(data, idmap, source_id):
 
 
 
-def seed_env_from_existing_allocations(env, alloc_rows, id_map, student_data, pool_ids=None):
-
-    env.state = env._init_state()
-    for sid, cls in alloc_rows:
-        # skip seeding any student who's up for reallocation
-        if pool_ids and sid in pool_ids:
-            continue
-        idx = id_map[sid]
-        features = student_data[idx]
-        env._update_state(cls, features, idx)
-
-
 def reallocate_pool_students(env, agent, pool_ids, id_map, student_data, unit_id):
     # now pool_ids is the set of real student_ids
     pool_idx = [id_map[sid] for sid in pool_ids if sid in id_map]
     updates = {}
     for idx in random.sample(pool_idx, len(pool_idx)):
         state_vec = env.get_state()
-        new_class = agent.act(state_vec)
+        new_class = agent.act(state_vec, env.action_mask())
         env.step(student_data[idx], new_class, idx)
         updates[idx] = new_class
 
@@ -3,6 +3,8 @@ from database.db import SessionLocal
 from database.models import Students, Clubs, Users, Teachers, SurveyResponse, Relationships, Allocations, Affiliations, Unit, CalculatedScores, AllocationsSummary, Feedback
 import pandas as pd
 import math
+import os
+import time
 import numpy as np
 import torch
 from torch_geometric.data import Data
@@ -13,8 +15,18 @@ from sqlalchemy import func, desc
 from survey_questions import SURVEY_QUESTION_MAP
 from model_utils import *
 from model.dqn.allocation_env import precompute_link_matrices
-from model.dqn.train_predict import train_and_allocate, returnEnvAndAgent, allocate_with_existing_model
+from model.dqn.train_predict import train_and_allocate, returnEnvAndAgent, load_inference_agent, allocate_with_existing_model, allocate_with_beam_search, allocate_with_milp
+from model.dqn.multi_start import allocate_multi_start
+from model.dqn.allocation_objective import evaluate_allocation
+from model.milp.milp_allocator import MILP_MAX_STUDENTS
+from model.registry import SHARED_DQN_CHECKPOINT
+from model.unit_cache import unit_cache, FEATURE_COLUMNS
+from model.dqn.what_if import score_class_moves
 from model.rgcn.predict_link import predict_links
+from model.rgcn.embedding_store import get_student_embeddings
+from model.rgcn.link_table import link_tables
+from model.rgcn.embedding_index import school_index
+from model.rgcn.predict_link import LINK_MAP
 
 survey_routes = Blueprint('survey_routes', __name__)
 
@@ -323,13 +335,39 @@ def allocate():
         return jsonify({'message': 'CORS preflight response'}), 200
     elif request.method == 'POST':
         data = request.get_json()
-        model = data.get('model_path')
+        model = data.get('model_path') or 'shared.pth'
         num_classes = data.get('num_classes')
 
-        if model not in ['dq5.pth', 'dq7.pth', 'dq9.pth']:
-            return jsonify({"error": "Invalid model path"}), 400
-        if num_classes not in [5, 7, 9]:
+        if not isinstance(num_classes, int) or not 2 <= num_classes <= 30:
             return jsonify({"error": "Invalid number of classes"}), 400
+        if model not in ['dq5.pth', 'dq7.pth', 'dq9.pth', 'shared.pth']:
+            return jsonify({"error": "Invalid model path"}), 400
+        # every class count runs on the shared policy; dq5/dq7/dq9 select a per-count model explicitly
+        if model != 'shared.pth' and model != 'dq{}.pth'.format(num_classes):
+            return jsonify({"error": "Model {} does not allocate {} classes".format(model, num_classes)}), 400
+        model_path = SHARED_DQN_CHECKPOINT if model == 'shared.pth' else "model/dqn/d{}.pth".format(num_classes)
+        if not os.path.exists(model_path):
+            return jsonify({"error": "No allocation model available for {} classes".format(num_classes)}), 400
+        strategy = data.get('strategy', 'greedy')
+        if strategy not in ['greedy', 'beam', 'milp', 'multistart']:
+            return jsonify({"error": "Invalid allocation strategy"}), 400
+        try:
+            beam_width = int(data.get('beam_width', 8))
+            if beam_width != float(data.get('beam_width', 8)) or beam_width < 1:
+                raise ValueError
+        except (TypeError, ValueError):
+            return jsonify({"error": "`beam_width` must be a positive integer"}), 400
+        beam_width = min(beam_width, 64)
+        try:
+            refine_ms = int(data.get('refine_ms', 0))
+            if refine_ms != float(data.get('refine_ms', 0)) or refine_ms < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            return jsonify({"error": "`refine_ms` must be a non-negative integer"}), 400
+        # local search runs inside the request, so at most 60 s of it
+        refine_ms = min(refine_ms, 60000)
+        time_limit = min(float(data.get('time_limit', 10)), 60.0)
+        num_starts = min(int(data.get('num_starts', 8)), 64)
         target_feature_avgs = generate_target_matrix(data.get('target_values'))
         db = SessionLocal()
         try:
@@ -346,6 +384,8 @@ def allocate():
             student_data = data.x.cpu().numpy()
             E= precompute_link_matrices(data)
             num_students = student_data.shape[0]
+            if strategy == 'milp' and num_students > MILP_MAX_STUDENTS:
+                return jsonify({"error": "MILP mode supports at most {} students".format(MILP_MAX_STUDENTS)}), 400
             target_class_size = math.ceil(num_students / num_classes)
             feature_dim = student_data.shape[1]
 
@@ -369,18 +409,40 @@ def allocate():
             #                    target_class_size,
             #                    target_feature_avgs,
             #                    student_data, E,250)
-            model_path = "model/dqn/d{}.pth".format(num_classes)
             print('"\n------------ using model: {}'.format(model_path))
             env, agent = returnEnvAndAgent(student_data, num_classes, target_class_size, target_feature_avgs, E,
                       model_path)
         
-            allocation_summary = allocate_with_existing_model(student_data, env, agent, unit_id,E,target_class_size,target_feature_avgs)
+            solver_info = None
+            if strategy == 'milp':
+                allocation_summary, solver_info = allocate_with_milp(student_data, env, agent, unit_id, E,
+                                                                     target_class_size, target_feature_avgs,
+                                                                     time_limit=time_limit, refine_ms=refine_ms)
+            elif strategy == 'multistart':
+                allocation_summary, solver_info = allocate_multi_start(student_data, env, agent, unit_id, E,
+                                                                       target_class_size, target_feature_avgs,
+                                                                       model_path, num_starts=num_starts,
+                                                                       deadline=time_limit, refine_ms=refine_ms)
+            elif strategy == 'beam':
+                allocation_summary = allocate_with_beam_search(student_data, env, agent, unit_id, E,
+                                                               target_class_size, target_feature_avgs,
+                                                               beam_width=beam_width, refine_ms=refine_ms)
+            else:
+                allocation_summary = allocate_with_existing_model(student_data, env, agent, unit_id,E,target_class_size,target_feature_avgs,
+                                                                  refine_ms=refine_ms)
         
             save_allocation_summary(unit_id, allocation_summary, db)
             upserted = save_allocations(db, env, id_map, unit_id)
+            unit_cache.invalidate(unit_id)
+            link_tables.schedule(unit_id)
 
+            # same objective for every strategy, so runs can be compared
+            objective = evaluate_allocation(env.assignment, student_data, num_classes,
+                                            target_class_size, target_feature_avgs, E)['objective']
             return jsonify({'message':'Allocated {} students into {} classes and updated {} records in database'.format(num_students,num_classes,upserted),
-                            'allocation_summary': allocation_summary}), 200
+                            'allocation_summary': allocation_summary,
+                            'solver': solver_info,
+                            'objective': float(objective)}), 200
         except Exception as e:
             print(e)
             return jsonify({"error": str(e)}), 500
@@ -831,7 +893,9 @@ def simulate_allocation():
         model,link_predictor = returnRgcnLinkPred()
         non_relationship_ids = get_non_relationship_ids(data,id_map,student_id)
         print("\n------------ Non relationship ids: ", non_relationship_ids)
-        predicted_links = predict_links(data.x, model, link_predictor, id_map[student_id], non_relationship_ids, id_map)
+        ids_by_idx = sorted(id_map, key=id_map.get)
+        emb = torch.from_numpy(get_student_embeddings(ids_by_idx, data.x.cpu().numpy()))
+        predicted_links = predict_links(data.x, model, link_predictor, id_map[student_id], non_relationship_ids, id_map, emb=emb)
         print("\n------------ Predicted links: ", predicted_links)
 
 
@@ -859,6 +923,164 @@ def simulate_allocation():
     finally:
         db.close()
 
+@survey_routes.route('/api/what-if/<int:student_id>', methods=['GET'])
+@teacher_login_required
+def what_if_moves(student_id):
+    """Scores moving one student into every class of the teacher's unit, best first."""
+    db = SessionLocal()
+    try:
+        teacher = db.query(Teachers).filter_by(emp_id=session.get('user_id')).one()
+        unit_id = teacher.manage_unit
+        summary_rows = (
+            db.query(AllocationsSummary)
+              .filter_by(unit_id=unit_id)
+              .order_by(AllocationsSummary.class_id)
+              .all()
+        )
+        if not summary_rows:
+            return jsonify({"error": "Unit has not been allocated yet"}), 404
+        num_classes = len(summary_rows)
+        target_feature_avgs = summary_target_matrix(summary_rows)
+
+        snap = unit_cache.get(db, unit_id)
+        with snap.lock:
+            idx = snap.id_map.get(student_id)
+            if idx is None or snap.labels[idx] < 0:
+                return jsonify({"error": f"Student {student_id} is not allocated in this unit"}), 404
+            target_class_size = math.ceil(snap.student_data.shape[0] / num_classes)
+            env = snap.get_env(num_classes, target_class_size, target_feature_avgs)
+            result = score_class_moves(env, snap.student_data, idx)
+
+        relations = list(EDGE_TYPES)
+        as_features = lambda row: {f: round(float(v), 3) for f, v in zip(FEATURE_COLUMNS, row)}
+        classes = []
+        for rank, c in enumerate(result['ranking']):
+            classes.append({
+                'class_id':          int(c),
+                'class_label':       summary_rows[c].class_label,
+                'rank':              rank + 1,
+                'score_delta':       round(float(result['score_delta'][c]), 3),
+                'new_count':         int(result['new_count'][c]),
+                'current_averages':  as_features(result['current_averages'][c]),
+                'new_averages':      as_features(result['new_averages'][c]),
+                'average_deltas':    as_features(result['new_averages'][c] - result['current_averages'][c]),
+                'target_deviation':  round(float(result['current_deviation'][c]), 4),
+                'new_target_deviation': round(float(result['new_deviation'][c]), 4),
+                'link_gains':        dict(zip(relations, result['link_gains'][c].tolist())),
+            })
+        current = result['current_class']
+        return jsonify({
+            'student_id':    student_id,
+            'current_class': current,
+            'link_losses':   dict(zip(relations, result['link_losses'].tolist())),
+            'current_class_without_student': {
+                'averages':         as_features(result['source_new_averages']),
+                'target_deviation': round(result['source_new_deviation'], 4),
+            },
+            'classes':       classes,
+        }), 200
+    except Exception as e:
+        print(e)
+        return jsonify({"error": str(e)}), 500
+    finally:
+        db.close()
+
+@survey_routes.route('/api/predicted-links', methods=['GET'])
+@teacher_login_required
+def get_predicted_links():
+    """
+    Reads the precomputed top-k predicted links of the teacher's unit.
+    Optional query args: student_id, link_type (repeatable), min_probability.
+    """
+    student_id = request.args.get('student_id', type=int)
+    link_types = request.args.getlist('link_type')
+    min_probability = request.args.get('min_probability', default=0.0, type=float)
+    db = SessionLocal()
+    try:
+        teacher = db.query(Teachers).filter_by(emp_id=session.get('user_id')).one()
+        unit_id = teacher.manage_unit
+        table = link_tables.get(unit_id)
+        if table is None:
+            link_tables.schedule(unit_id)
+            return jsonify({"message": "Predicted links are being computed, try again shortly"}), 202
+
+        sources = [student_id] if student_id is not None else table.student_ids.tolist()
+        links = []
+        for sid in sources:
+            links.extend(table.links_for(sid, min_probability, link_types))
+        return jsonify({
+            'unit_id':         unit_id,
+            'top_k':           int(table.targets.shape[1]),
+            'stale':           link_tables.is_stale(unit_id),
+            'predicted_links': links,
+        }), 200
+    except Exception as e:
+        print(e)
+        return jsonify({"error": str(e)}), 500
+    finally:
+        db.close()
+
+@survey_routes.route('/api/suggestions/<int:student_id>', methods=['GET'])
+@teacher_login_required
+def get_link_suggestions(student_id):
+    """
+    Students across the school that `student_id` is most likely to form
+    each relation with, from the embedding index. Targets the student
+    already reported are skipped. Optional query args: link_type
+    (repeatable, every relation by default), k, min_probability and
+    other_classes=1 to only suggest students outside the student's class.
+    """
+    link_types = request.args.getlist('link_type') or [t for t in LINK_MAP.values() if t != 'no_link']
+    k = min(request.args.get('k', default=10, type=int), 50)
+    min_probability = request.args.get('min_probability', default=0.0, type=float)
+    other_classes = request.args.get('other_classes', default=0, type=int)
+    relation_of = {t: r for r, t in LINK_MAP.items() if t != 'no_link'}
+    unknown = [t for t in link_types if t not in relation_of]
+    if unknown:
+        return jsonify({"error": f"Unknown link type(s): {unknown}"}), 400
+
+    db = SessionLocal()
+    try:
+        start = time.perf_counter()
+        index = school_index.get(db)
+        if student_id not in index.row_of:
+            return jsonify({"error": f"No scores found for student {student_id}"}), 404
+
+        teacher = db.query(Teachers).filter_by(emp_id=session.get('user_id')).one()
+        unit_id = teacher.manage_unit
+        exclude = {t for (t,) in db.query(Relationships.target).filter_by(source=student_id).all()}
+        own_class = db.query(Allocations.class_id).filter_by(unit_id=unit_id, student_id=student_id).scalar()
+        if other_classes and own_class is not None:
+            exclude.update(s for (s,) in db.query(Allocations.student_id)
+                                           .filter_by(unit_id=unit_id, class_id=own_class).all())
+
+        results = index.query(student_id, [relation_of[t] for t in link_types], k, exclude, min_probability)
+
+        target_ids = {t for pairs in results.values() for t, _ in pairs}
+        names = {s.student_id: s for s in db.query(Students).filter(Students.student_id.in_(target_ids)).all()}
+        classes = dict(db.query(Allocations.student_id, Allocations.class_id)
+                         .filter(Allocations.unit_id == unit_id, Allocations.student_id.in_(target_ids)).all())
+        suggestions = {}
+        for link_type, pairs in results.items():
+            suggestions[link_type] = [{
+                'student_id':  t,
+                'first_name':  names[t].first_name if t in names else None,
+                'last_name':   names[t].last_name if t in names else None,
+                'class_id':    classes.get(t),
+                'probability': round(p, 3),
+            } for t, p in pairs]
+        return jsonify({
+            'student_id':  student_id,
+            'class_id':    own_class,
+            'suggestions': suggestions,
+            'seconds':     round(time.perf_counter() - start, 4),
+        }), 200
+    except Exception as e:
+        print(e)
+        return jsonify({"error": str(e)}), 500
+    finally:
+        db.close()
+
 @survey_routes.route('/api/student-info/<int:student_id>', methods=['GET'])
 @teacher_login_required  # Specifically only accessible by teachers
 def get_student_info_by_teacher(student_id):
@@ -1234,6 +1456,7 @@ def update_student_relationships():
             ))
 
         db.commit()
+        unit_cache.mark_links_dirty(student_id)
         return jsonify({"message": "Relationships updated."}), 200
 
     except Exception as e:
@@ -1305,64 +1528,49 @@ def reallocate():
         )
         num_classes = len(summary_rows)
         print('\n****************** Num Classes: ', num_classes)
-        target_attrs = [
-            'target_academic_engagement_score',
-            'target_academic_wellbeing_score',
-            'target_mental_health_score',
-            'target_growth_mindset_score',
-            'target_gender_norm_score',
-            'target_social_attitude_score',
-            'target_school_environment_score'
-        ]
-        target_vals = [
-        [float(getattr(r, attr)) for attr in target_attrs]
-        for r in summary_rows
-        ]
-        target_feature_avgs = np.array(target_vals, dtype=float)
+        target_feature_avgs = summary_target_matrix(summary_rows)
         print('\n****************** Target Features: ', target_feature_avgs)
-        # 3) Load all students' scores & relationships and build data object
-        #    generate_dataframes returns (unit_id, scores_df, relationships_df)
-        _, scores_df, rel_df = generate_dataframes(db, user_id)
-        print('\n****************** Finished generating dataframe ', scores_df)
-        rel_df = map_link_types(rel_df)
-        scores_df, edges_df, id_map = map_student_ids(scores_df, rel_df)
-        data_obj = create_data_object(scores_df, edges_df)
-        print('\n****************** Data Object: ', data_obj)
-        E = precompute_link_matrices(data_obj)
-        print('\n****************** E : ', E)
-        student_data = data_obj.x.cpu().numpy()
-        print('\n****************** Student Data: ', student_data)
-        target_class_size = math.ceil(student_data.shape[0] / num_classes)
-        print('\n******************  Target Class Size: ', target_class_size)
-        # 4) Initialize env & agent
-        model_path = f"model/dqn/d{num_classes}.pth"
-        env, agent = returnEnvAndAgent(
-            student_data,
-            num_classes,
-            target_class_size,
-            target_feature_avgs,
-            E,
-            model_path
-        )
-        print('\n******************  Env : ', env)
-        # 5) Seed the env with existing allocations
-        alloc_rows = (
-            db.query(Allocations.student_id, Allocations.class_id)
-              .filter_by(unit_id=unit_id)
-              .all()
-        )
-        seed_env_from_existing_allocations(env, alloc_rows, id_map, student_data,reassign_ids)
-        print("\n******************  Environment state after seeding:")
-        print(env.state)
-        # 6) Reallocate only pool students
-        allocation_summary,updates = reallocate_pool_students(
-            env, agent, reassign_ids, id_map, student_data,unit_id
-        )
-        print("\n******************  Update after reallocations: ", updates)
-        print("\n******************  Allocation summary: ", allocation_summary)
-        # 7) Persist only those updates and clear their reallocation flag
-        updated_count = save_reallocation_updates(db, unit_id, updates, id_map)
-        save_allocation_summary(unit_id, allocation_summary, db)
+        # 3) Reuse the cached unit snapshot; only students whose scores or
+        #    links were saved since it was built are re-read from the DB
+        snap = unit_cache.get(db, unit_id)
+        # unallocated students (class_id NULL) are held as -1 in the snapshot
+        if any(snap.id_map.get(row.student_id) is not None and
+               snap.labels[snap.id_map[row.student_id]] != (-1 if row.old_class is None else row.old_class)
+               for row in pool_details):
+            # allocations changed elsewhere (e.g. another worker): rebuild once
+            unit_cache.invalidate(unit_id)
+            snap = unit_cache.get(db, unit_id)
+        with snap.lock:
+            id_map = snap.id_map
+            student_data = snap.student_data
+            target_class_size = math.ceil(student_data.shape[0] / num_classes)
+            print('\n******************  Target Class Size: ', target_class_size)
+            # 4) Load the agent and the env holding the unit's current allocation
+            model_path = SHARED_DQN_CHECKPOINT
+            agent = load_inference_agent(student_data.shape[1], num_classes, model_path)
+            env = snap.get_env(num_classes, target_class_size, target_feature_avgs)
+            # 5) Take only the pool students out of their classes
+            for sid in reassign_ids:
+                idx = id_map.get(sid)
+                if idx is not None:
+                    env.remove_student(idx, student_data[idx])
+            print("\n******************  Environment state after removing pool:")
+            print(env.counts)
+            try:
+                # 6) Reallocate only pool students
+                allocation_summary,updates = reallocate_pool_students(
+                    env, agent, reassign_ids, id_map, student_data,unit_id
+                )
+                print("\n******************  Update after reallocations: ", updates)
+                print("\n******************  Allocation summary: ", allocation_summary)
+                # 7) Persist only those updates and clear their reallocation flag
+                updated_count = save_reallocation_updates(db, unit_id, updates, id_map)
+                save_allocation_summary(unit_id, allocation_summary, db)
+            except Exception:
+                # the cached env no longer matches the DB
+                unit_cache.invalidate(unit_id)
+                raise
+            snap.set_labels(updates)
         updated_students = []
         for sid, old_cls, fn, ln in pool_details:
             idx = id_map.get(sid)
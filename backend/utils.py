@@ -3,6 +3,10 @@ import pandas as pd
 from database.models import CalculatedScores,SurveyResponse, Relationships, Affiliations
 from sqlalchemy.inspection import inspect
 import json
+from model.unit_cache import unit_cache
+from model.rgcn.embedding_store import embedding_store
+from model.rgcn.link_table import link_tables
+from model.rgcn.embedding_index import school_index
 
 def normalizeScale(x, max_value):
     try:
@@ -117,6 +121,10 @@ def saveFeaturesToDb(db,features):
     )
     db.merge(response)
     db.commit()
+    unit_cache.mark_features_dirty(features['student_id'])
+    embedding_store.invalidate(features['student_id'])
+    link_tables.mark_dirty(features['student_id'], db)
+    school_index.mark_dirty(features['student_id'])
   # or however you get your Session
 
 def saveRelationshipsToDb(response,session):
@@ -152,6 +160,7 @@ def saveRelationshipsToDb(response,session):
     for obj in orm_objs:
         session.merge(obj)
     session.commit()
+    unit_cache.mark_links_dirty(source_id)
 
 def saveAffiliationsToDb(db,data):
     source_id = data.get('student_id')
@@ -24,7 +24,6 @@ export default function StudentAllocationSetup() {
   const [unallocatedStudents, setUnallocatedStudents] = useState(0);
   const [numClasses, setNumClasses] = useState(null);
   const [studentsPerClass, setStudentsPerClass] = useState(null);
-  const [modelPath, setModelPath] = useState('');
   const [classLabels, setClassLabels] = useState([]);
   const [targetValues, setTargetValues] = useState([]);
   const [globalAverages, setGlobalAverages] = useState({});
@@ -53,7 +52,6 @@ export default function StudentAllocationSetup() {
   const handleClassSelection = (count) => {
     setNumClasses(count);
     setStudentsPerClass(Math.floor(unallocatedStudents / count));
-    setModelPath(`dq${count}.pth`);
     setClassLabels(
       Array.from({ length: count }, (_, i) => `class_${i}`)
     );
@@ -85,7 +83,6 @@ export default function StudentAllocationSetup() {
     }
     setAllocating(true);
     const payload = {
-      model_path: modelPath,
       num_classes: numClasses,
       target_values: Array.from({ length: numClasses }, (_, i) => {
         const scores = {};